@@ -1,8 +1,10 @@
 import asyncio
+import hmac
 import os
 
-from tg_load.tg_load import setup
+from tg_load.tg_load import setup, post_shutdown
 from tg_load.globals import env
+from tg_load.utils import loads_json
 
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, Response, status
@@ -19,8 +21,13 @@ async def lifespan(_: FastAPI):
     await application.start()
     yield
     await application.stop()
+    await post_shutdown(application)
     await application.shutdown()
 
+WEBHOOK_SECRET_TOKEN = env("WEBHOOK_SECRET_TOKEN", default = None)
+# updates with larger bodies are converted in a worker thread, so that the event loop is not blocked
+DE_JSON_THREAD_THRESHOLD = 16 * 1024
+
 app = FastAPI(lifespan=lifespan)
 
 @app.get("/healthz")
@@ -29,11 +36,16 @@ def healthz():
 
 @app.post("/webhook")
 async def telegram_webhook(request: Request):
-    if env("WEBHOOK_SECRET_TOKEN", default = None):
-        secret = request.headers.get("x-telegram-bot-api-secret-token")
-        if secret != WEBHOOK_SECRET_TOKEN:
+    if WEBHOOK_SECRET_TOKEN:
+        secret = request.headers.get("x-telegram-bot-api-secret-token", "")
+        if not hmac.compare_digest(secret.encode(), WEBHOOK_SECRET_TOKEN.encode()):
             return Response(status_code=status.HTTP_401_UNAUTHORIZED)
-    data = await request.json()
-    update = Update.de_json(data, application.bot)
-    await application.process_update(update)
+    body = await request.body()
+    data = loads_json(body)
+    if len(body) > DE_JSON_THREAD_THRESHOLD:
+        update = await asyncio.to_thread(Update.de_json, data, application.bot)
+    else:
+        update = Update.de_json(data, application.bot)
+    # the update processor handles the updates from different chats concurrently, and the ones from the same chat in order
+    await application.update_processor.process_update(update, application.process_update(update))
     return Response(status_code=status.HTTP_204_NO_CONTENT)
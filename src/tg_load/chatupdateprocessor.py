@@ -0,0 +1,57 @@
+import asyncio
+
+from typing import Any, Awaitable
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+class ChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    An update processor that processes updates from different chats concurrently, while the updates from each chat are processed one by one, in the order they arrive.
+
+    See https://docs.python-telegram-bot.org/en/stable/telegram.ext.baseupdateprocessor.html
+
+    Attributes
+    ----------
+    max_concurrent_updates : int
+        The maximum number of updates being processed concurrently (including those waiting for the previous updates from their chats).
+
+    Methods
+    -------
+    do_process_update(update, coroutine):
+        Await `coroutine` once the previous updates from the chat of `update` are processed.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        """Pass `max_concurrent_updates` to ``BaseUpdateProcessor`` and create the registry of per-chat locks."""
+        super().__init__(max_concurrent_updates)
+        # chat id -> (lock, number of updates holding or waiting for the lock)
+        self.__chat_locks: dict[int, tuple[asyncio.Lock, int]] = {}
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]):
+        """Await `coroutine` once the previous updates from the chat of `update` are processed. Updates without a chat are processed immediately."""
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            await coroutine
+            return
+        lock, users = self.__chat_locks.get(chat.id, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        self.__chat_locks[chat.id] = (lock, users + 1)
+        try:
+            async with lock:
+                await coroutine
+        finally:
+            lock, users = self.__chat_locks[chat.id]
+            # the locks of idle chats are dropped, so that the registry doesn't grow with every chat the bot has ever seen
+            if users == 1:
+                del self.__chat_locks[chat.id]
+            else:
+                self.__chat_locks[chat.id] = (lock, users - 1)
+
+    async def initialize(self):
+        """Nothing to initialize."""
+
+    async def shutdown(self):
+        """Nothing to shut down."""
@@ -1,59 +1,25 @@
-import ast
 import asyncio
 import json
 import os
 import sys
-import tempfile
+import traceback
 
-from pathlib import Path
+from .utils import atomic_write, dumps_json
 
 
-async def async_dump(filepath: str, content):
-    """An async wrapper for the safe ``json.dump(content, filepath, indent = 4, sort_keys = True)``."""
-    path = Path(filepath)
-    path.parent.mkdir(parents=True, exist_ok=True)
-    
-    fd, tmppath = tempfile.mkstemp(
-        prefix = path.name + ".",
-        suffix = ".tmp",
-        dir = path.parent
-    )
-    try:
-        with os.fdopen(fd, "w", encoding = "utf-8") as file:
-            json.dump(content, file, indent = 4, sort_keys = True)
-            file.flush()
-            os.fsync(fd)  # use `file.fileno()` instead of `fd` in case `fd` is not available
-
-        os.replace(tmppath, path)
-
-        if os.name == "posix":
-            dir_fd = os.open(path.parent, os.O_DIRECTORY)
-            try:
-                os.fsync(dir_fd)
-            finally:
-                os.close(dir_fd)
-    finally:
-        Path(tmppath).unlink(missing_ok=True)
-
-
-async def async_upload_from_string_json(blob, content):
-    """An async wrapper for ``blob.upload_from_string(json.dumps(content, indent = 4, sort_keys = True), content_type="application/json; charset=utf-8")``."""
-    data = json.dumps(content, indent = 4, sort_keys = True)
-    blob.upload_from_string(data, content_type="application/json; charset=utf-8")
-
-
-async def worker(task_queue: asyncio.Queue()):
-    """Endlessly run tasks from `task_queue`."""
-    while True:
-        task_coro, done_future = await task_queue.get()
-        try:
-            await task_coro
-        except Exception as e:
-            done_future.set_exception(e)
-        else:
-            done_future.set_result(True)
-        finally:
-            task_queue.task_done()
+async def async_dump(filepath: str, content, fsync: bool = False, pretty: bool = False):
+    """
+    An async wrapper for safely writing `content` to `filepath` as JSON (compact, unless `pretty` is ``True``).
+
+    The file is replaced atomically. If `fsync` is ``True``, it is also queued for the next batched fsync.
+    """
+    await atomic_write(filepath, dumps_json(content, pretty = pretty), fsync = fsync)
+
+
+async def async_upload_from_string_json(blob, content, pretty: bool = False):
+    """An async wrapper for ``blob.upload_from_string(dumps_json(content, pretty = pretty), content_type="application/json; charset=utf-8")``. The upload runs in a worker thread."""
+    data = dumps_json(content, pretty = pretty)
+    await asyncio.to_thread(blob.upload_from_string, data, content_type="application/json; charset=utf-8")
 
 
 class FeatureState:
@@ -71,16 +37,22 @@ class FeatureState:
 
     Methods
     -------
+    aclose():
+        Write the pending changes immediately.
     backup():
-        Write the preference's value to the file specified by `self.filepath`.
+        Write the preference's value to the file specified by `self.filepath`. Bursts of calls are coalesced into a single write.
     add(item):
         Add `item` to `self.set`.
     discard(item):
         Discard  `item` from `self.set`
     """
     
-    def __init__(self, filepath: str, bucket = None):
-        """If `bucket` is not ``None``, set `self.blob` to ``bucket.blob(filepath)``. Initialize `self.features`, set `self.filepath` from the corresponding arguments and create a task queue."""
+    def __init__(self, filepath: str, bucket = None, flush_delay: float = 0.1, max_pending: int = 64, fsync: bool = False, pretty: bool = False):
+        """
+        If `bucket` is not ``None``, set `self.blob` to ``bucket.blob(filepath)``. Initialize `self.features`, set `self.filepath` from the corresponding arguments and create a lock serializing the writes.
+
+        `flush_delay` (in seconds) and `max_pending` control how `backup()` calls are coalesced: a write happens `flush_delay` seconds after the first unflushed request, or immediately once `max_pending` requests have been accumulated. If `fsync` is ``True``, local writes are flushed to disk in periodic batches; otherwise, only the atomicity of the replacement is guaranteed. If `pretty` is ``True``, the backups are indented (e.g. for debugging).
+        """
         self.blob = bucket.blob(filepath) if bucket else None
         self.features = {
             "inst" : True,
@@ -88,21 +60,19 @@ class FeatureState:
             "ytm": True,
             "yt": True
         }
-        self.__queue = asyncio.Queue()
+        self.__lock = asyncio.Lock()
         self.filepath = filepath
         self.__import_from_backup()
-        self.__worker_task = None
-
-
-    def __del__(self):
-        """Cancel the running worker."""
-        if self.__worker_task:
-            self.__worker_task.cancel()
-
-    def __ensure_worker(self):
-        """Start a worker for the `self.__queue`."""
-        if self.__worker_task is None:
-            self.__worker_task = asyncio.create_task(worker(self.__queue))
+        # the content of the last successful write (or of the imported backup), used to skip no-op backups
+        self.__last_written = dict(self.features)
+        self.__pending = 0
+        self.__flush_delay = flush_delay
+        self.__max_pending = max_pending
+        self.__flush_task = None
+        self.__flush_future = None
+        self.__flush_now = asyncio.Event()
+        self.__fsync = fsync
+        self.__pretty = pretty
 
     def __update_from_dict(self, data: dict) -> None:
         """Set `self.features` from `data`. Unrelated keys will be ignored. For non-boolean values, ``ValueError`` exceptions will be raised."""
@@ -136,26 +106,55 @@ class FeatureState:
                 except Exception:
                     print(traceback.format_exc(), file = sys.stderr)
 
+    async def __delayed_flush(self):
+        """Wait for `self.__flush_delay` seconds (or until `self.__max_pending` backups are requested), then write `self.features` to `self.filepath` once the previous write is finished."""
+        try:
+            await asyncio.wait_for(self.__flush_now.wait(), self.__flush_delay)
+        except TimeoutError:
+            pass
+        future = self.__flush_future
+        self.__flush_task = None
+        self.__flush_future = None
+        self.__flush_now.clear()
+        self.__pending = 0
+        # take a snapshot, so that the write includes every change made before the flush and none made after it
+        snapshot = dict(self.features)
+        try:
+            async with self.__lock:
+                if not self.blob:
+                    await async_dump(self.filepath, snapshot, fsync = self.__fsync, pretty = self.__pretty)
+                else:
+                    await async_upload_from_string_json(self.blob, snapshot, pretty = self.__pretty)
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            self.__last_written = snapshot
+            future.set_result(True)
+
+    async def aclose(self):
+        """Write the pending changes of `self.features` immediately, if any, and wait for the write to finish. Call this on shutdown, before the event loop is closed."""
+        if self.__flush_task is not None:
+            self.__flush_now.set()
+            await asyncio.shield(self.__flush_task)
+        # a write started before is no longer referenced by `self.__flush_task`, but holds the lock until it finishes
+        async with self.__lock:
+            pass
+
     async def backup(self) -> asyncio.Future:
-        """Add a task to the queue to write `self.features` to `self.filepath`."""
-        self.__ensure_worker()
-        future = asyncio.get_running_loop().create_future()
-        await self.__queue.put((
-            async_dump(self.filepath, self.features) if not self.blob else async_upload_from_string_json(self.blob, self.features),
-            future
-        ))
-        return future
-
-    async def __set(self, key, value):
-        """An async wrapper for `self.features[key] = value`."""
-        self.features[key] = value
-
-    async def set(self, feature: str, state: bool) -> asyncio.Future:
-        """Add a task to the queue to set `self.features[feature]` to `state`."""
-        self.__ensure_worker()
-        future = asyncio.get_running_loop().create_future()
-        await self.__queue.put((
-            self.__set(feature, state),
-            future
-        ))
-        return future
+        """Schedule a write of `self.features` to `self.filepath`. Calls made before the write starts are coalesced, and all of them get the same future. If `self.features` hasn't changed since the last write and no write is in flight, an already completed future is returned."""
+        # while a write is in flight, `self.__last_written` may not match the storage once it finishes, so a write is scheduled anyway
+        if self.__flush_task is None and not self.__lock.locked() and self.features == self.__last_written:
+            future = asyncio.get_running_loop().create_future()
+            future.set_result(True)
+            return future
+        self.__pending += 1
+        if self.__flush_task is None:
+            self.__flush_future = asyncio.get_running_loop().create_future()
+            self.__flush_task = asyncio.create_task(self.__delayed_flush())
+        if self.__pending >= self.__max_pending:
+            self.__flush_now.set()
+        return self.__flush_future
+
+    def set(self, feature: str, state: bool):
+        """Set `self.features[feature]` to `state`. Call `backup()` to persist the change."""
+        self.features[feature] = state
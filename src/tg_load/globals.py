@@ -2,22 +2,37 @@ import asyncio
 import os
 import pathlib
 import tomllib
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache
 from environs import env
 from platformdirs import user_state_dir
 
-from .utils import deep_merge
+from .utils import deep_merge, install_uvloop, sync_pending
 from .preference import Preference
 from .featurestate import FeatureState
 
 import instaloader
 from instaloader.__main__ import import_session
+from requests.adapters import HTTPAdapter
 
 
 PROJECT_NAME = "tg_load"
 
 DIR = pathlib.Path(__file__).resolve().parents[0]
 ROOT_DIR = DIR.parents[1] if "src" in str(DIR) else DIR
-STATE_DIR = "state" if ROOT_DIR != DIR or env("STATE_BUCKET", default = None) else user_state_dir(PROJECT_NAME)
+
+# Prepare envs
+env.read_env()
+STATE_BUCKET = env("STATE_BUCKET", default = None)
+TEST_LOGIN = env.bool("TEST_LOGIN", default = True)
+FFMPEG_LOCATION = env("FFMPEG_LOCATION", default = None)
+FSYNC = env.bool("TG_LOAD_FSYNC", default = False)
+# where the downloads are stored until they are sent; the working directory by default
+DOWNLOAD_DIR = env("TG_LOAD_TMPDIR", default = "")
+if DOWNLOAD_DIR:
+    os.makedirs(DOWNLOAD_DIR, exist_ok = True)
+
+STATE_DIR = "state" if ROOT_DIR != DIR or STATE_BUCKET else user_state_dir(PROJECT_NAME)
 
 FEATURE_NAMES = {
     "inst" : "Instagram",
@@ -26,9 +41,6 @@ FEATURE_NAMES = {
     "yt": "YouTube (audio)"
 }
 
-# Prepare envs
-env.read_env()
-
 # Prepare configs
 config_default_path = os.path.join(DIR, "settings", "config.default.toml")
 with open(config_default_path, 'rb') as config_default_file:
@@ -38,54 +50,91 @@ with open(config_override_path, 'rb') as config_override_file:
     config_override = tomllib.load(config_override_file)
     config = deep_merge(config, config_override)
 
-L_captions = instaloader.Instaloader(
-    quiet = True,
-    download_video_thumbnails = False,
-    save_metadata = False,
-    filename_pattern = "file"
-)
-L_no_captions = instaloader.Instaloader(
-    quiet = True,
-    download_video_thumbnails = False,
-    save_metadata = False,
-    filename_pattern = "file",
-    post_metadata_txt_pattern = ""  # don't save captions
-)
-# L.login("username", "password") does not work since login file request does not receive sessionid
-# A workaround for missing sessionid (see https://github.com/instaloader/instaloader/issues/2487):
-# Merge https://github.com/instaloader/instaloader/pull/2577 (session import fixes)
-# Optionally, merge https://github.com/borisbabic/browser_cookie3/pull/226 (Firefox MSiX support)
-# Optionally, merge https://github.com/borisbabic/browser_cookie3/pull/225 (Firefox via Flatpak support)
-if (config["session_import"]["browser"]):
-    for L in [L_captions, L_no_captions]:
-        import_session(config["session_import"]["browser"], L)
-else:
-    for L in [L_captions, L_no_captions]:
-        L.load_session(config["session_import"]["username"], {
+@cache
+def get_instaloaders() -> tuple[instaloader.Instaloader, instaloader.Instaloader]:
+    """
+    Create the Instaloader instances (with and without captions) and load the Instagram session they share.
+
+    The instances are created on the first call only, so that importing this module doesn't import the browser cookies. Call `test_instaloader_logins()` afterwards to test the sessions if needed.
+
+    Returns
+    -------
+    tuple[instaloader.Instaloader, instaloader.Instaloader]
+        `L_captions` and `L_no_captions`.
+    """
+    L_captions = instaloader.Instaloader(
+        quiet = True,
+        download_video_thumbnails = False,
+        save_metadata = False,
+        filename_pattern = "file"
+    )
+    L_no_captions = instaloader.Instaloader(
+        quiet = True,
+        download_video_thumbnails = False,
+        save_metadata = False,
+        filename_pattern = "file",
+        post_metadata_txt_pattern = ""  # don't save captions
+    )
+    # L.login("username", "password") does not work since login file request does not receive sessionid
+    # A workaround for missing sessionid (see https://github.com/instaloader/instaloader/issues/2487):
+    # Merge https://github.com/instaloader/instaloader/pull/2577 (session import fixes)
+    # Optionally, merge https://github.com/borisbabic/browser_cookie3/pull/226 (Firefox MSiX support)
+    # Optionally, merge https://github.com/borisbabic/browser_cookie3/pull/225 (Firefox via Flatpak support)
+    if (config["session_import"]["browser"]):
+        import_session(config["session_import"]["browser"], L_captions)
+    else:
+        L_captions.load_session(config["session_import"]["username"], {
             "csrftoken": config["session_import"]["csrftoken"],
             "sessionid": config["session_import"]["sessionid"],
             "ds_user_id": config["session_import"]["ds_user_id"],
             "mid": config["session_import"]["mid"],
             "ig_did": config["session_import"]["ig_did"]
         })
-        if env.bool("TEST_LOGIN", default = True):
-            L.test_login()
+    # requests keeps up to 10 connections per host by default, while up to config["workers"]["instaloader"] requests may run at once; the extra ones would open a new TLS connection every time
+    L_captions.context._session.mount("https://", HTTPAdapter(pool_maxsize = max(10, config["workers"]["instaloader"])))
+    # the instances differ only in what they save, so they share the session (its cookies and connection pool) rather than importing it twice
+    L_no_captions.context._session = L_captions.context._session
+    L_no_captions.context.username = L_captions.context.username
+    return L_captions, L_no_captions
+
 
+async def test_instaloader_logins(*loaders: instaloader.Instaloader) -> None:
+    """Concurrently perform a test login for each of `loaders`, if the session was loaded from config.toml and ``TEST_LOGIN`` is not disabled."""
+    if not config["session_import"]["browser"] and TEST_LOGIN:
+        await asyncio.gather(*(asyncio.to_thread(L.test_login) for L in loaders))
+
+
+install_uvloop()
 try:
     loop = asyncio.get_running_loop()
 except RuntimeError:
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
 
-if env("STATE_BUCKET", default = None):
+if STATE_BUCKET:
     from google.cloud import storage
-    BUCKET = storage.Client().bucket(env("STATE_BUCKET"))
+    BUCKET = storage.Client().bucket(STATE_BUCKET)
 else:
     BUCKET = None
 
-active_chat_ids = Preference(os.path.join(STATE_DIR, "active_chat_ids.txt"), bucket = BUCKET)
-no_captions_chat_ids = Preference(os.path.join(STATE_DIR, "no_captions_chat_ids.txt"), bucket = BUCKET)
-no_notifications_chat_ids = Preference(os.path.join(STATE_DIR, "no_notifications_chat_ids.txt"), bucket = BUCKET)
-banned_user_ids = Preference(os.path.join(STATE_DIR, "banned_user_ids.txt"), bucket = BUCKET)
+# the state is imported concurrently, since with STATE_BUCKET each file takes a couple of requests
+with ThreadPoolExecutor(thread_name_prefix = "state") as executor:
+    preferences = [
+        executor.submit(Preference, os.path.join(STATE_DIR, filename), bucket = BUCKET, fsync = FSYNC)
+        for filename in ["active_chat_ids.txt", "no_captions_chat_ids.txt", "no_notifications_chat_ids.txt", "banned_user_ids.txt"]
+    ]
+    feature_state_future = executor.submit(FeatureState, os.path.join(STATE_DIR, "features.json"), bucket = BUCKET, fsync = FSYNC)
+active_chat_ids, no_captions_chat_ids, no_notifications_chat_ids, banned_user_ids = [preference.result() for preference in preferences]
+feature_state = feature_state_future.result()
+
 
-feature_state = FeatureState(os.path.join(STATE_DIR, "features.json"), bucket = BUCKET)
+async def close_state() -> None:
+    """Write the pending changes of all the preferences and the feature state, and flush the queued fsyncs."""
+    await asyncio.gather(
+        active_chat_ids.aclose(),
+        no_captions_chat_ids.aclose(),
+        no_notifications_chat_ids.aclose(),
+        banned_user_ids.aclose(),
+        feature_state.aclose()
+    )
+    await sync_pending()
@@ -0,0 +1,25 @@
+from telegram import Message, MessageEntity
+from telegram.ext import filters
+
+
+class LinkFilter(filters.MessageFilter):
+    """
+    A filter for messages with links, i.e. with ``url`` or ``text_link`` entities in their text or caption.
+
+    Equivalent to ``(filters.TEXT & (filters.Entity('url') | filters.Entity('text_link'))) | (filters.CAPTION & (filters.CaptionEntity('url') | filters.CaptionEntity('text_link')))``, but the entities are scanned once.
+
+    See https://docs.python-telegram-bot.org/en/stable/telegram.ext.filters.html#telegram.ext.filters.MessageFilter
+
+    Methods
+    -------
+    filter(message):
+        Return whether `message` contains links.
+    """
+
+    # the types of the entities of links
+    LINK_ENTITY_TYPES = frozenset({MessageEntity.URL, MessageEntity.TEXT_LINK})
+
+    def filter(self, message: Message) -> bool:
+        """Return whether the text or the caption of `message` contains ``url`` or ``text_link`` entities."""
+        # a message has either a text (with entities) or a caption (with caption entities), so at most one of the tuples is non-empty
+        return any(entity.type in self.LINK_ENTITY_TYPES for entity in message.entities or message.caption_entities)
@@ -1,67 +1,15 @@
 import ast
 import asyncio
+import json
 import os
 import sys
-import tempfile
 
-from pathlib import Path
-
-
-async def async_add(target_set: set, item):
-    """An async wrapper for ``set.add()``."""
-    target_set.add(item)
-
-
-async def async_discard(target_set: set, item):
-    """An async wrapper for ``set.discard()``."""
-    target_set.discard(item)
-
-
-async def async_write(filepath: str, content: str):
-    """An async wrapper for the safe ``file.write()``."""
-    path = Path(filepath)
-    path.parent.mkdir(parents=True, exist_ok=True)
-    
-    fd, tmppath = tempfile.mkstemp(
-        prefix = path.name + ".",
-        suffix = ".tmp",
-        dir = path.parent
-    )
-    try:
-        with os.fdopen(fd, "w", encoding = "utf-8") as file:
-            file.write(content)
-            file.flush()
-            os.fsync(fd)  # use `file.fileno()` instead of `fd` in case `fd` is not available
-
-        os.replace(tmppath, path)
-
-        if os.name == "posix":
-            dir_fd = os.open(path.parent, os.O_DIRECTORY)
-            try:
-                os.fsync(dir_fd)
-            finally:
-                os.close(dir_fd)
-    finally:
-        Path(tmppath).unlink(missing_ok=True)
+from .utils import atomic_write, dumps_json, loads_json
 
 
 async def async_upload_from_string_text(blob, text: str):
-    """An async wrapper for ``blob.upload_from_string()`` with ``content_type="text/plain; charset=utf-8"``."""
-    blob.upload_from_string(text, content_type="text/plain; charset=utf-8")
-
-
-async def worker(task_queue: asyncio.Queue()):
-    """Endlessly run tasks from `task_queue`."""
-    while True:
-        task_coro, done_future = await task_queue.get()
-        try:
-            await task_coro
-        except Exception as e:
-            done_future.set_exception(e)
-        else:
-            done_future.set_result(True)
-        finally:
-            task_queue.task_done()
+    """An async wrapper for ``blob.upload_from_string()`` with ``content_type="text/plain; charset=utf-8"``. The upload runs in a worker thread."""
+    await asyncio.to_thread(blob.upload_from_string, text, content_type="text/plain; charset=utf-8")
 
 
 class Preference:
@@ -79,36 +27,51 @@ class Preference:
 
     Methods
     -------
+    aclose():
+        Write the pending changes immediately.
     backup():
-        Write the preference's value to the file specified by `self.filepath`.
+        Write the preference's value to the file specified by `self.filepath`. Bursts of calls are coalesced into a single write.
     add(item):
         Add `item` to `self.set`.
     discard(item):
         Discard  `item` from `self.set`
     """
     
-    def __init__(self, filepath: str, bucket = None):
-        """If `bucket` is not ``None``, set `self.blob` to ``bucket.blob(filepath)``. Create `self.set`, set `self.filepath` from the corresponding arguments and create a task queue."""
+    def __init__(self, filepath: str, bucket = None, flush_delay: float = 0.1, max_pending: int = 64, fsync: bool = False, stable_order: bool | None = None):
+        """
+        If `bucket` is not ``None``, set `self.blob` to ``bucket.blob(filepath)``. Create `self.set`, set `self.filepath` from the corresponding arguments and create a lock serializing the writes.
+
+        `flush_delay` (in seconds) and `max_pending` control how `backup()` calls are coalesced: a write happens `flush_delay` seconds after the first unflushed request, or immediately once `max_pending` requests have been accumulated. If `fsync` is ``True``, local writes are flushed to disk in periodic batches; otherwise, only the atomicity of the replacement is guaranteed.
+
+        If `stable_order` is ``True``, items are sorted on every write, so that equal sets produce equal backups. Defaults to ``True`` for bucket blobs and ``False`` for local files.
+        """
         self.blob = bucket.blob(filepath) if bucket else None
         self.set = set()
-        self.__queue = asyncio.Queue()
+        self.__lock = asyncio.Lock()
         self.filepath = filepath
         self.__import_from_backup()
-        self.__worker_task = None
+        # the content of the last successful write (or of the imported backup), used to skip no-op backups
+        self.__last_written = frozenset(self.set)
+        self.__pending = 0
+        self.__flush_delay = flush_delay
+        self.__max_pending = max_pending
+        self.__flush_task = None
+        self.__flush_future = None
+        self.__flush_now = asyncio.Event()
+        self.__fsync = fsync
+        self.__stable_order = stable_order if stable_order is not None else self.blob is not None
 
     def __iter__(self):
         """Inherit from `self.set` iterator."""
         return iter(self.set)
 
-    def __del__(self):
-        """Cancel the running worker."""
-        if self.__worker_task:
-            self.__worker_task.cancel()
+    def __contains__(self, item) -> bool:
+        """Check whether `item` is in `self.set` (without iterating over it)."""
+        return item in self.set
 
-    def __ensure_worker(self):
-        """Start a worker for the `self.__queue`."""
-        if self.__worker_task is None:
-            self.__worker_task = asyncio.create_task(worker(self.__queue))
+    def __len__(self) -> int:
+        """Return the size of `self.set`."""
+        return len(self.set)
 
     def __import_from_backup(self):
         """Try to import `self.set` from `self.filepath`. May not be async safe, so it's private (and is called only once, in `__init__()`)."""
@@ -117,43 +80,83 @@ class Preference:
                 with open(self.filepath, "r", encoding = "utf-8") as file:
                     try:
                         raw = file.read()
-                        self.set = ast.literal_eval(raw)
+                        self.__load(raw)
                     except Exception as e:
                         print(e, file = sys.stderr)
         else:
             if self.blob.exists():
                 try:
                     raw = self.blob.download_as_text(encoding = "utf-8")
-                    self.set = ast.literal_eval(raw)
+                    self.__load(raw)
                 except Exception as e:
                     print(e, file = sys.stderr)
 
+    def __load(self, raw: str):
+        """Set `self.set` from `raw`, newline-delimited JSON with one item per line. Backups in the legacy format (a Python set literal) are accepted as well."""
+        try:
+            # orjson.JSONDecodeError is a subclass of json.JSONDecodeError
+            self.set = {loads_json(line) for line in raw.splitlines() if line}
+        except json.JSONDecodeError:
+            self.set = ast.literal_eval(raw)
+
+    def __dumps(self) -> str:
+        """Return `self.set` as newline-delimited JSON, one item per line. Items are sorted only if `self.__stable_order` is ``True``."""
+        items = sorted(self.set) if self.__stable_order else self.set
+        return "\n".join(dumps_json(item) for item in items)
+
+    async def __delayed_flush(self):
+        """Wait for `self.__flush_delay` seconds (or until `self.__max_pending` backups are requested), then write `self.set` to `self.filepath` once the previous write is finished."""
+        try:
+            await asyncio.wait_for(self.__flush_now.wait(), self.__flush_delay)
+        except TimeoutError:
+            pass
+        future = self.__flush_future
+        self.__flush_task = None
+        self.__flush_future = None
+        self.__flush_now.clear()
+        self.__pending = 0
+        try:
+            async with self.__lock:
+                # `self.set` is serialized here rather than in `backup()`, so the write includes every mutation made before the flush
+                snapshot = frozenset(self.set)
+                if not self.blob:
+                    await atomic_write(self.filepath, self.__dumps(), fsync = self.__fsync)
+                else:
+                    await async_upload_from_string_text(self.blob, self.__dumps())
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            self.__last_written = snapshot
+            future.set_result(True)
+
+    async def aclose(self):
+        """Write the pending changes of `self.set` immediately, if any, and wait for the write to finish. Call this on shutdown, before the event loop is closed."""
+        if self.__flush_task is not None:
+            self.__flush_now.set()
+            await asyncio.shield(self.__flush_task)
+        # a write started before is no longer referenced by `self.__flush_task`, but holds the lock until it finishes
+        async with self.__lock:
+            pass
+
     async def backup(self) -> asyncio.Future:
-        """Add a task to the queue to write `self.set` to `self.filepath`."""
-        self.__ensure_worker()
-        future = asyncio.get_running_loop().create_future()
-        await self.__queue.put((
-            async_write(self.filepath, str(self.set)) if not self.blob else async_upload_from_string_text(self.blob, str(self.set)),
-            future
-        ))
-        return future
-
-    async def add(self, item) -> asyncio.Future:
-        """Add a task to the queue to add `item` to `self.set`."""
-        self.__ensure_worker()
-        future = asyncio.get_running_loop().create_future()
-        await self.__queue.put((
-            async_add(self.set, item),
-            future
-        ))
-        return future
-
-    async def discard(self, item) -> asyncio.Future:
-        """Add a task to the queue to discard `item` from `self.set`."""
-        self.__ensure_worker()
-        future = asyncio.get_running_loop().create_future()
-        await self.__queue.put((
-            async_discard(self.set, item),
-            future
-        ))
-        return future
+        """Schedule a write of `self.set` to `self.filepath`. Calls made before the write starts are coalesced, and all of them get the same future. If `self.set` hasn't changed since the last write and no write is in flight, an already completed future is returned."""
+        # while a write is in flight, `self.__last_written` may not match the storage once it finishes, so a write is scheduled anyway
+        if self.__flush_task is None and not self.__lock.locked() and self.set == self.__last_written:
+            future = asyncio.get_running_loop().create_future()
+            future.set_result(True)
+            return future
+        self.__pending += 1
+        if self.__flush_task is None:
+            self.__flush_future = asyncio.get_running_loop().create_future()
+            self.__flush_task = asyncio.create_task(self.__delayed_flush())
+        if self.__pending >= self.__max_pending:
+            self.__flush_now.set()
+        return self.__flush_future
+
+    def add(self, item):
+        """Add `item` to `self.set`. Call `backup()` to persist the change."""
+        self.set.add(item)
+
+    def discard(self, item):
+        """Discard `item` from `self.set`. Call `backup()` to persist the change."""
+        self.set.discard(item)
@@ -20,12 +20,8 @@ def main():
     commands_default_path = os.path.join(DIRECTORY, "settings", "commands.default.txt")
     commands_override_path = os.path.join(DIRECTORY, "settings", "commands.txt")
     commands_path = commands_override_path if os.path.isfile(commands_override_path) else commands_default_path
-    with open(commands_path, "r") as file:
-        lines = [line.strip() for line in file]
-
-    commands = []
-    for i in range(0, len(lines), 2):
-        commands.append(BotCommand(lines[i], lines[i + 1]))
+    lines = pathlib.Path(commands_path).read_text(encoding = "utf-8").splitlines()
+    commands = [BotCommand(command.strip(), description.strip()) for command, description in zip(lines[::2], lines[1::2])]
 
     loop.run_until_complete(
         application.bot.set_my_commands(commands)
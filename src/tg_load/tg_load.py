@@ -1,34 +1,38 @@
 import asyncio
 import io
 import logging
-import multiprocessing
 import os
-import pathlib
+import re
 import shutil
 import sys
+import tempfile
+import threading
+import time
 import traceback
-from contextlib import contextmanager
+from contextlib import ExitStack, asynccontextmanager, contextmanager
 from typing import Optional, Callable
 from types import MethodType
-from concurrent.futures import ProcessPoolExecutor, TimeoutError
-from functools import partial
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
 
-from .globals import DIR, ROOT_DIR, BUCKET, FEATURE_NAMES, env, config, L_captions, L_no_captions, active_chat_ids, no_captions_chat_ids, no_notifications_chat_ids, banned_user_ids, feature_state
+from .utils import listdir_by_ctime
+from .chatupdateprocessor import ChatUpdateProcessor
+from .linkfilter import LinkFilter
+from .globals import DIR, ROOT_DIR, STATE_BUCKET, FFMPEG_LOCATION, DOWNLOAD_DIR, BUCKET, FEATURE_NAMES, env, config, get_instaloaders, test_instaloader_logins, active_chat_ids, no_captions_chat_ids, no_notifications_chat_ids, banned_user_ids, feature_state, close_state
 
-from telegram import Update, Message, InputMediaPhoto, InputMediaVideo, InputMediaAudio, InputMediaDocument, Bot
+from telegram import Update, Message, InputFile, InputMediaPhoto, InputMediaVideo, InputMediaAudio, InputMediaDocument, Bot
 from telegram.error import Forbidden
-from telegram.ext import Defaults, Application, ApplicationBuilder, CallbackContext, ContextTypes, CommandHandler, MessageHandler, filters
+from telegram.ext import AIORateLimiter, Defaults, Application, ApplicationBuilder, CallbackContext, ContextTypes, CommandHandler, MessageHandler, filters
 
 import instaloader
-from instaloader import Profile, StoryItem
+from instaloader import Profile, Story, StoryItem
 from instaloader.exceptions import InstaloaderException, AbortDownloadException
 
 import ytm
 from ytm.apis.YouTubeMusicDL.YouTubeMusicDL import YouTubeMusicDL
 import yt_dlp
 
-from mutagen.mp3 import MP3
-from mutagen.id3 import ID3, APIC
+from mutagen.id3 import ID3, ID3NoHeaderError, APIC
 
 
 class Timeout(Exception):
@@ -41,18 +45,186 @@ class Timeout(Exception):
     pass
 
 
-async def repeat_until_task_done(interval: float, task: asyncio.Task, action: Callable, *action_args, **action_kwargs):
-    """Repeat `action` every `interval` seconds until `task` is done."""
+# a dedicated pool for blocking instaloader calls, so that they don't queue behind (or hold up) the other work of the default executor
+instaloader_executor = ThreadPoolExecutor(
+    max_workers = config["workers"]["instaloader"],
+    thread_name_prefix = "instaloader"
+)
+# yt-dlp downloads are mostly waiting for the network and ffmpeg, so they run in threads
+yt_thread_executor = ThreadPoolExecutor(
+    max_workers = config["workers"]["yt_threads"],
+    thread_name_prefix = "yt-dlp"
+)
+
+
+def init_yt_worker():
+    """Initialize a worker process of ``yt_executor``: create its ``YouTubeMusicDL`` in advance, so that the first download in the worker doesn't wait for that."""
+    # an exception raised by an initializer breaks the whole pool, so a failure is only printed (and get_ytml() is retried by the download)
+    try:
+        get_ytml()
+    except Exception:
+        print(
+            f"Failed to initialize a yt-dlp worker process:\n{traceback.format_exc()}",
+            file = sys.stderr
+        )
+
+
+# a pool of warm worker processes for the downloads that have been timed out in a thread, as a process can be terminated if it hangs again
+yt_executor = ProcessPoolExecutor(max_workers = config["workers"]["yt"], initializer = init_yt_worker)
+# incremented by reset_yt_executor(), so that a download broken by the reset of another one can tell that it isn't its own failure
+yt_executor_generation = 0
+# the number of yt_thread_executor threads still running downloads that have been timed out
+timed_out_yt_threads = 0
+
+
+def reset_yt_executor():
+    """
+    Replace ``yt_executor`` with a new pool and terminate the worker processes of the old one.
+
+    A timed out download can't be interrupted from the outside, so its worker has to be terminated. Downloads still running in the old pool fail with ``BrokenProcessPool``; they can compare ``yt_executor_generation`` with the one they have been submitted in to retry without counting the attempt.
+    """
+    global yt_executor, yt_executor_generation
+
+    old_executor = yt_executor
+    yt_executor = ProcessPoolExecutor(max_workers = config["workers"]["yt"], initializer = init_yt_worker)
+    yt_executor_generation += 1
+    # ProcessPoolExecutor provides no public way to stop the running workers, and shutdown() drops the references to them
+    processes = list((old_executor._processes or {}).values())
+    old_executor.shutdown(wait = False, cancel_futures = True)
+    for process in processes:
+        process.terminate()
+
+
+def track_timed_out_yt_thread(future: Future):
+    """
+    Count the ``yt_thread_executor`` thread running the timed out download of `future` in ``timed_out_yt_threads`` until the download finishes.
+
+    A download stuck outside of yt-dlp's progress updates (e.g., in ffmpeg) can't be interrupted, so it is only logged here, and ``download_yt_and_reply()`` stops using the threads while too many of them are held.
+    """
+    global timed_out_yt_threads
+
+    timed_out_yt_threads += 1
+    print(
+        f"A timed out yt-dlp download is still running in its thread; {timed_out_yt_threads}/{config['workers']['yt_threads']} threads are held by timed out downloads.",
+        file = sys.stderr
+    )
+    loop = asyncio.get_running_loop()
+
+    def release(_):
+        global timed_out_yt_threads
+        timed_out_yt_threads -= 1
+
+    def schedule_release(future):
+        # the callback runs in the thread that completes the future, so the counter is updated in the event loop
+        try:
+            loop.call_soon_threadsafe(release, future)
+        except RuntimeError:
+            # the loop has been closed on shutdown
+            pass
+
+    future.add_done_callback(schedule_release)
+
+
+async def repeat_until_task_done(interval: float, task: asyncio.Future, action: Callable, *action_args, initial_delay: float = 0, **action_kwargs):
+    """
+    Repeat `action` every `interval` seconds until `task` is done, starting after `initial_delay` seconds. Returns as soon as `task` is done, without waiting for the rest of the interval.
+
+    Exceptions raised by `action` are printed rather than raised, so that a failed heartbeat (e.g. a chat action) neither stops the next ones nor is reported as an error of `task`.
+    """
+    if initial_delay > 0:
+        await asyncio.wait({task}, timeout = initial_delay)
     while not task.done():
-        await action(*action_args, **action_kwargs)
-        await asyncio.sleep(interval)
+        try:
+            await action(*action_args, **action_kwargs)
+        except Exception:
+            print(
+                f"Failed to repeat {getattr(action, '__name__', action)}:\n{traceback.format_exc()}",
+                file = sys.stderr
+            )
+        await asyncio.wait({task}, timeout = interval)
+
+
+@asynccontextmanager
+async def removing_directory(path: str):
+    """An asynchronous context manager that removes the directory `path` with all its files (if it exists) on exit, without blocking the event loop."""
+    try:
+        yield path
+    finally:
+        await asyncio.to_thread(shutil.rmtree, path, ignore_errors = True)
+
+
+@asynccontextmanager
+async def download_directory(name: str):
+    """
+    An asynchronous context manager that creates a new directory in ``DOWNLOAD_DIR``, named `name` followed by a unique suffix, and removes it with all its files on exit (see ``removing_directory()``).
+
+    The suffix keeps apart the downloads of concurrent handlings of the same message (e.g. a link handled by ``check_message()`` and by a mention replying to it).
+    """
+    path = await asyncio.to_thread(tempfile.mkdtemp, prefix = f"{name}-", dir = DOWNLOAD_DIR)
+    async with removing_directory(path):
+        yield path
 
 
-async def repeat_while_process_alive(interval: float, process: multiprocessing.Process, action: Callable, *action_args, **action_kwargs):
-    """Repeat `action` every `interval` seconds while `process` is alive."""
-    while process.is_alive():
-        await action(*action_args, **action_kwargs)
-        await asyncio.sleep(interval)
+# a chat action is displayed for 5 seconds (or until a message is sent), see https://core.telegram.org/bots/api#sendchataction
+CHAT_ACTION_DURATION = 5
+# when each chat action was last sent to each chat (and topic), see time.monotonic(); accessed from the event loop only
+chat_action_times: dict[tuple[int, Optional[int], str], float] = {}
+
+
+async def send_chat_action(message: Message, action: str):
+    """Send the chat `action` to the chat of `message` and remember when it was sent. Exceptions are printed rather than raised."""
+    key = (message.chat.id, message.message_thread_id, action)
+    now = time.monotonic()
+    # the expired entries are dropped once in a while, so that the dict doesn't grow with every chat
+    if len(chat_action_times) >= 1024:
+        for expired_key in [k for k, sent in chat_action_times.items() if now - sent > CHAT_ACTION_DURATION]:
+            del chat_action_times[expired_key]
+    chat_action_times[key] = now
+    try:
+        await message.reply_chat_action(action)
+    except Exception:
+        # the action isn't displayed, so the next heartbeat shouldn't wait for it
+        chat_action_times.pop(key, None)
+        print(
+            f"Failed to set chat action:\n{traceback.format_exc()}",
+            file = sys.stderr
+        )
+
+
+async def await_with_chat_action(awaitable, message: Message, action: str):
+    """
+    Await `awaitable` while repeating the chat `action` in the chat of `message`, and return its result.
+
+    The chat action is repeated every ``CHAT_ACTION_DURATION`` seconds and is stopped as soon as `awaitable` finishes, whatever the outcome. If the same action was sent recently (see ``send_chat_action()``), the first repetition waits until it expires.
+    Unlike with ``asyncio.TaskGroup``, the exceptions of `awaitable` are propagated as is rather than wrapped in an ``ExceptionGroup``, so that the callers can handle ``AbortDownloadException`` separately.
+    """
+    task = asyncio.ensure_future(awaitable)
+    last_sent = chat_action_times.get((message.chat.id, message.message_thread_id, action))
+    reply_chat_action_task = asyncio.create_task(
+        repeat_until_task_done(
+            CHAT_ACTION_DURATION,
+            task,
+            # send_chat_action(message, action)
+            send_chat_action,
+            message,
+            action,
+            initial_delay = last_sent + CHAT_ACTION_DURATION - time.monotonic() if last_sent is not None else 0
+        )
+    )
+    try:
+        return await task
+    finally:
+        await stop_task(reply_chat_action_task)
+
+
+async def stop_task(task: Optional[asyncio.Future]):
+    """Cancel `task` unless it is done, and wait until it finishes. Exceptions raised by `task` are not propagated. Does nothing if `task` is ``None``."""
+    if task is None:
+        return
+    if not task.done():
+        task.cancel()
+    # unlike awaiting `task`, asyncio.wait() neither raises its exceptions nor swallows the cancellation of the current task
+    await asyncio.wait({task})
 
 
 @contextmanager
@@ -62,7 +234,7 @@ def error_catcher(self, extra_info: Optional[str] = None):
 
     Notes
     -----
-    ``application.bot`` must be set before calling this
+    ``application.bot`` and ``event_loop`` must be set before calling this
     """
     # to keep the format of the logs, we have to copy-paste
     # WARNING: check this method when updating instaloader
@@ -74,13 +246,20 @@ def error_catcher(self, extra_info: Optional[str] = None):
         else:
             error = '{}'.format(err)
         self.error(error)
-        asyncio.create_task(
-            send_to_logging_chats(error, application.bot)
-        )
+        # instaloader runs in worker threads, so the error is queued on the event loop rather than sent from here
+        event_loop.call_soon_threadsafe(queue_log, error)
         if self.raise_all_errors:
             raise
 
 
+# see https://core.telegram.org/bots/api#html-style
+HTML_STYLE_TRANSLATION = str.maketrans({
+    '&': '&amp;',
+    '<': '&lt;',
+    '>': '&gt;'
+})
+
+
 def sanitize_html_style(msg: str) -> str:
     """
     Replace forbidden in Telegram HTML style symbols with the corresponding HTML entities. See https://core.telegram.org/bots/api#html-style
@@ -95,53 +274,139 @@ def sanitize_html_style(msg: str) -> str:
     str
         Modified `msg`, so that it can be send in an HTML-styled Telegram message.
     """
-    res = msg
-    res = res.replace('&', '&amp;')
-    res = res.replace('<', '&lt;')
-    res = res.replace('>', '&gt;')
-    return res
+    return msg.translate(HTML_STYLE_TRANSLATION)
 
 
-async def send_to_logging_chats(msg: str, bot: Bot, **format_kwargs):
-    """Send `msg` to the logging chats."""
-    if not config["logging_chat_ids"]:
-        return
-    for chat_id in config["logging_chat_ids"]:
+# limits the number of messages broadcast() has in flight at once, so that a notification to many chats doesn't occupy the whole connection pool; the rate itself is paced by AIORateLimiter (see setup())
+send_semaphore = asyncio.Semaphore(25)
+
+
+async def send_html_message(chat_id: int, text: str, bot: Bot):
+    """Send `text` to the chat with `chat_id` as an HTML-styled message. Exceptions are printed rather than raised."""
+    async with send_semaphore:
         try:
             await bot.send_message(
                 chat_id,
-                msg.format(**format_kwargs),
+                text,
                 parse_mode = 'HTML',
             )
         except Exception as e:
-            if "empty" in str(e):
-                return
-            else:
+            if "empty" not in str(e):
                 print(traceback.format_exc(), file = sys.stderr)
 
 
+async def broadcast(msg: str, bot: Bot, chat_ids, **format_kwargs):
+    """Send `msg` to each of `chat_ids` concurrently. `msg` is formatted with `format_kwargs` only if any are given."""
+    try:
+        # messages without replacement fields may contain arbitrary braces (e.g. in tracebacks or notifications), so they are sent as is
+        text = msg.format(**format_kwargs) if format_kwargs else msg
+    except (KeyError, IndexError, ValueError):
+        print(traceback.format_exc(), file = sys.stderr)
+        return
+    await asyncio.gather(
+        *(send_html_message(chat_id, text, bot) for chat_id in chat_ids)
+    )
+
+
+async def send_to_logging_chats(msg: str, bot: Bot, **format_kwargs):
+    """Send `msg` to the logging chats. `msg` is formatted with `format_kwargs` only if any are given."""
+    if not config["logging_chat_ids"]:
+        return
+    await broadcast(msg, bot, config["logging_chat_ids"], **format_kwargs)
+
+
+async def report_error(message: Message, action: str, item, error: Exception):
+    """
+    Report `error`, the exception being handled, that occured when `action` (e.g. ``'downloading the post'``) was done for `item`.
+
+    Print the traceback, and concurrently reply to `message` and send the traceback to the logging chats.
+    For ``AbortDownloadException``, the error is reported as critical, and the reply doesn't include its details.
+    """
+    formatted_traceback = traceback.format_exc()
+    critical = isinstance(error, AbortDownloadException)
+    severity = "A critical error" if critical else "An error"
+    print(
+        f"{severity} occured when {action} {item}:\n{formatted_traceback}",
+        file = sys.stderr
+    )
+    description = f"{severity} occured when {action} <code>{sanitize_html_style(str(item))}</code>"
+    await asyncio.gather(
+        message.reply_html(
+            f"{description}." if critical else f"{description}:\n<pre><code class=\"language-log\">{sanitize_html_style(str(error))}</code></pre>"
+        ),
+        send_to_logging_chats(
+            f"{description}:\n<pre><code class=\"language-log\">{sanitize_html_style(formatted_traceback)}</code></pre>",
+            message.get_bot()
+        )
+    )
+
+
 async def send_to_active_chats(msg: str, bot: Bot, chats_to_exclude = None, ignore_disabled_notifications = False, **format_kwargs):
-    """Send formatted `msg` to the active chats (except of `chats_to_exclude`). The type of `chats_to_exclude` must allow ``in`` usage."""
+    """Send `msg` to the active chats (except of `chats_to_exclude`). `msg` is formatted with `format_kwargs` only if any are given. The type of `chats_to_exclude` must allow ``in`` usage."""
     config_context = config["messages"]["notifications"]
 
     if not active_chat_ids:
         return
     if not ignore_disabled_notifications:
         msg += config_context["disable_notifications_prompt"]
-    for chat_id in active_chat_ids:
-        if (not chats_to_exclude or chat_id not in chats_to_exclude) and \
-        (ignore_disabled_notifications or not no_notifications_chat_ids or chat_id not in no_notifications_chat_ids):
-            try:
-                await bot.send_message(
-                    chat_id,
-                    msg.format(**format_kwargs),
-                    parse_mode = 'HTML',
-                )
-            except Exception as e:
-                if "empty" in str(e):
-                    return
-                else:
-                    print(traceback.format_exc(), file = sys.stderr)
+    chat_ids = [
+        chat_id
+        for chat_id in list(active_chat_ids)
+        if (not chats_to_exclude or chat_id not in chats_to_exclude) and
+        (ignore_disabled_notifications or not no_notifications_chat_ids or chat_id not in no_notifications_chat_ids)
+    ]
+    await broadcast(msg, bot, chat_ids, **format_kwargs)
+
+
+# the messages queued by queue_log(), e.g. instaloader errors; bounded, so that an error storm doesn't pile up messages in memory
+log_queue = asyncio.Queue(maxsize = 1024)
+log_sender_task = None
+# the maximum number of queued messages sent to the logging chats as one message
+LOG_BATCH_SIZE = 8
+# the maximum length of a queued message, so that a batch of them fits in a single Telegram message (4096 characters)
+LOG_MESSAGE_LENGTH = 480
+
+
+def queue_log(msg: str):
+    """Queue `msg` (plain text) for the logging chats, and start ``send_queued_logs()`` if it isn't running. Must be called from the event loop; if the queue is full, `msg` is printed and dropped."""
+    global log_sender_task
+
+    if not config["logging_chat_ids"]:
+        return
+    try:
+        log_queue.put_nowait(msg if len(msg) <= LOG_MESSAGE_LENGTH else msg[:LOG_MESSAGE_LENGTH - 1] + "…")
+    except asyncio.QueueFull:
+        print(f"The logging queue is full, dropped:\n{msg}", file = sys.stderr)
+        return
+    if log_sender_task is None:
+        log_sender_task = asyncio.create_task(send_queued_logs(application.bot))
+
+
+async def send_queued_logs(bot: Bot):
+    """Send the messages queued by ``queue_log()`` to the logging chats, up to `LOG_BATCH_SIZE` messages at once, until the queue is empty."""
+    global log_sender_task
+
+    try:
+        while not log_queue.empty():
+            batch = []
+            while not log_queue.empty() and len(batch) < LOG_BATCH_SIZE:
+                batch.append(log_queue.get_nowait())
+            await send_to_logging_chats(
+                "\n\n".join(f"<pre><code class=\"language-log\">{sanitize_html_style(msg)}</code></pre>" for msg in batch),
+                bot
+            )
+    finally:
+        log_sender_task = None
+
+
+async def disable_feature(feature: str, bot: Bot):
+    """Disable `feature`, and notify the active and the logging chats about that. The notifications are sent while the feature state is being saved."""
+    feature_state.set(feature, False)
+    await asyncio.gather(
+        await feature_state.backup(),
+        send_to_active_chats(config["messages"]["notifications"]["feature_disabled"], bot, feature = FEATURE_NAMES[feature]),
+        send_to_logging_chats(config["messages"]["notifications"]["feature_disabled"], bot, feature = FEATURE_NAMES[feature])
+    )
 
 
 async def application_exception_handler(update: Optional[object], context: CallbackContext):
@@ -150,29 +415,67 @@ async def application_exception_handler(update: Optional[object], context: Callb
 
     For reference, see https://docs.python-telegram-bot.org/en/stable/telegram.ext.application.html#telegram.ext.Application.add_error_handler
     """
+    formatted_traceback = traceback.format_exc()
     print(
-        f"An exception occurred:\n{traceback.format_exc()}",
+        f"An exception occurred:\n{formatted_traceback}",
         file = sys.stderr
     )
-    error = f"An exception occurred:\n<pre><code class=\"language-log\">{sanitize_html_style(traceback.format_exc())}</code></pre>"
+    if not config["logging_chat_ids"]:
+        return
+    error = f"An exception occurred:\n<pre><code class=\"language-log\">{sanitize_html_style(formatted_traceback)}</code></pre>"
     await send_to_logging_chats(error, context.bot)
 
 
+# the bot's name, as returned by get_my_name(), and the time it was fetched at (see time.monotonic())
+bot_name_cache: Optional[tuple[str, float]] = None
+# for how long (in seconds) the cached bot's name is used
+BOT_NAME_TTL = 600
+
+
+async def get_bot_name(bot: Bot) -> str:
+    """Return the bot's name. It is fetched from Telegram Bot API at most once per `BOT_NAME_TTL` seconds."""
+    global bot_name_cache
+
+    if bot_name_cache is None or time.monotonic() - bot_name_cache[1] > BOT_NAME_TTL:
+        bot_name_cache = ((await bot.get_my_name()).name, time.monotonic())
+    return bot_name_cache[0]
+
+
 async def format_message(message: str, context: ContextTypes.DEFAULT_TYPE = None, **kwargs) -> str:
     """Format `message` with the allowed replacement fields (see config.toml)."""
+    # messages without replacement fields (and escaped braces) are returned as is
+    if "{" not in message and "}" not in message:
+        return message
     res = message
     if "{bot_name}" in res:
-        # WARNING: this generates a request to Telegram Bot API every time the bot's name is used
-        # however, the bot is much more limited by instagram account restrictions, so it will never reach the Telegram's limit
-        res = res.format(bot_name = (await context.bot.get_my_name()).name, bot_username = context.application.bot.name, **kwargs)
+        res = res.format(bot_name = await get_bot_name(context.bot), bot_username = context.application.bot.name, **kwargs)
     else:
         res = res.format(bot_username = context.application.bot.name, **kwargs)
     return res
 
 
+async def reply_formatted(message: Message, text: str, context: ContextTypes.DEFAULT_TYPE = None, **kwargs):
+    """Reply to `message` with `text` formatted by ``format_message()`` as an HTML-styled message."""
+    await message.reply_html(
+        await format_message(text, context, **kwargs)
+    )
+
+
+# the admin ids as a set, so that is_admin() is a single lookup
+ADMIN_IDS = frozenset(config["admin_ids"])
+
+
 def is_admin(user_id: int) -> bool:
     """Check whether the user with `user_id` is the bot administrator."""
-    return user_id in config["admin_ids"]
+    return user_id in ADMIN_IDS
+
+
+def parse_id(arg: str) -> Optional[int]:
+    """Convert `arg` to a chat or user id. Return ``None`` if `arg` is not a (possibly negative) decimal integer."""
+    # invalid args are rejected without raising an exception; Telegram ids fit in 64 bits, so longer args (which int() may refuse to convert) are invalid too
+    if len(arg) > 20 or not arg.removeprefix("-").isdecimal():
+        return None
+    return int(arg)
 
 
 async def ensure_admin(message: Message, context: ContextTypes.DEFAULT_TYPE) -> bool:
@@ -216,6 +519,14 @@ async def ensure_not_banned_author(message: Message, context: ContextTypes.DEFAU
     return res                    
 
 
+async def ensure_allowed(message: Message, context: ContextTypes.DEFAULT_TYPE, public_reply = True) -> bool:
+    """Check whether the bot is enabled in the chat where `message` was sent and the author of `message` is not banned, and reply with a corresponding error message if not. `public_reply` is passed to ``ensure_active_chat()``."""
+    # most updates pass both checks, so they are answered without the replying helpers
+    if message.chat.id in active_chat_ids and message.from_user.id not in banned_user_ids:
+        return True
+    return await ensure_active_chat(message, context, public_reply) and await ensure_not_banned_author(message, context)
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     A handler for ``/start`` command.
@@ -265,8 +576,7 @@ async def enable(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await format_message(config_context["no_need"], context)
         )
     elif await ensure_admin(message, context):
-        future = await active_chat_ids.add(update.effective_chat.id)
-        await future
+        active_chat_ids.add(update.effective_chat.id)
         future = await active_chat_ids.backup()
         await future
         await message.reply_html(
@@ -291,8 +601,7 @@ async def disable(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await format_message(config_context["no_need"], context)
         )
     elif await ensure_admin(message, context):
-        future = await active_chat_ids.discard(update.effective_chat.id)
-        await future
+        active_chat_ids.discard(update.effective_chat.id)
         future = await active_chat_ids.backup()
         await future
         await message.reply_html(
@@ -313,14 +622,13 @@ async def disable_captions(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # update.effective_message is not None since it's a command handler
     message = update.effective_message
-    if await ensure_active_chat(message, context) and await ensure_not_banned_author(message, context):
+    if await ensure_allowed(message, context):
         if update.effective_chat.id in no_captions_chat_ids:
             await message.reply_html(
                 await format_message(config_context["no_need"], context)
             )
         else:
-            future = await no_captions_chat_ids.add(update.effective_chat.id)
-            await future
+            no_captions_chat_ids.add(update.effective_chat.id)
             future = await no_captions_chat_ids.backup()
             await future
             await message.reply_html(
@@ -341,14 +649,13 @@ async def enable_captions(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # update.effective_message is not None since it's a command handler
     message = update.effective_message
-    if await ensure_active_chat(message, context) and await ensure_not_banned_author(message, context):
+    if await ensure_allowed(message, context):
         if update.effective_chat.id not in no_captions_chat_ids:
             await message.reply_html(
                 await format_message(config_context["no_need"], context)
             )
         else:
-            future = await no_captions_chat_ids.discard(update.effective_chat.id)
-            await future
+            no_captions_chat_ids.discard(update.effective_chat.id)
             future = await no_captions_chat_ids.backup()
             await future
             await message.reply_html(
@@ -369,14 +676,13 @@ async def disable_notifications(update: Update, context: ContextTypes.DEFAULT_TY
     
     # update.effective_message is not None since it's a command handler
     message = update.effective_message
-    if await ensure_active_chat(message, context) and await ensure_not_banned_author(message, context):
+    if await ensure_allowed(message, context):
         if update.effective_chat.id in no_notifications_chat_ids:
             await message.reply_html(
                 await format_message(config_context["no_need"], context)
             )
         else:
-            future = await no_notifications_chat_ids.add(update.effective_chat.id)
-            await future
+            no_notifications_chat_ids.add(update.effective_chat.id)
             future = await no_notifications_chat_ids.backup()
             await future
             await message.reply_html(
@@ -397,14 +703,13 @@ async def enable_notifications(update: Update, context: ContextTypes.DEFAULT_TYP
     
     # update.effective_message is not None since it's a command handler
     message = update.effective_message
-    if await ensure_active_chat(message, context) and await ensure_not_banned_author(message, context):
+    if await ensure_allowed(message, context):
         if update.effective_chat.id not in no_notifications_chat_ids:
             await message.reply_html(
                 await format_message(config_context["no_need"], context)
             )
         else:
-            future = await no_notifications_chat_ids.discard(update.effective_chat.id)
-            await future
+            no_notifications_chat_ids.discard(update.effective_chat.id)
             future = await no_notifications_chat_ids.backup()
             await future
             await message.reply_html(
@@ -439,9 +744,39 @@ async def state(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+# media types by (lowercase) file extension, see https://core.telegram.org/type/storage.FileType
+MEDIA_TYPES = {
+    ".jpg": "photo",
+    ".png": "photo",
+    ".webp": "photo",
+    ".mp4": "video",
+    ".mv4": "video",
+    ".f4v": "video",
+    ".lrv": "video",
+    ".mov": "video",
+    ".mp3": "audio",
+    ".txt": "caption"
+}
+
+
+async def open_input_file(path: str, files: ExitStack) -> InputFile:
+    """Open the file at `path` for sending in a media group. The file is not read in advance, but streamed when uploading. It is closed together with `files`."""
+    # opening may block on slow storage, so it runs in a worker thread
+    file = files.enter_context(await asyncio.to_thread(open, path, 'rb'))
+    return InputFile(file, attach = True, read_file_handle = False)
+
+
+def read_caption(path: str) -> str:
+    """Read a caption from the file at `path`, truncated to fit in a message caption. Only the characters that fit are read."""
+    with open(path, 'r', encoding = 'UTF-8') as file:
+        caption = file.read(1024)
+    # message captions must be 0-1024 characters after entities parsing
+    return caption if len(caption) < 1024 else caption[:1023] + "…"
+
+
 async def reply_media(target: str, message: Message, compress: bool = True):
     """
-    Reply to `message` with images and videos (and a caption if desired) from `target`, then remove `target`.
+    Reply to `message` with images and videos (and a caption if desired) from `target`.
 
     Reply with an error message in case of any errors.
 
@@ -454,26 +789,28 @@ async def reply_media(target: str, message: Message, compress: bool = True):
     compress : bool, optional
         Whether to compress the images and videos from `target` when sending. Default is ``True``.
     """
-    filenames = sorted(os.listdir(target))
+    filenames = sorted(await asyncio.to_thread(os.listdir, target))
             
-    media = []
-    errors = ""
-    errors_formatted = ""
-    errors_formatted_traceback = ""
-    for filename in filenames:
-        suffix = pathlib.PurePath(filename).suffix
-        try:
-            with open(os.path.join(target, filename), 'rb') as file:
-                # see https://core.telegram.org/type/storage.FileType
-                if suffix in [".jpg", ".png", ".webp"]:
+    # the files are closed once the replies are sent
+    with ExitStack() as files:
+        media = []
+        errors = ""
+        errors_formatted = ""
+        errors_formatted_traceback = ""
+        for filename in filenames:
+            media_type = MEDIA_TYPES.get(os.path.splitext(filename)[1].lower())
+            try:
+                if media_type == "photo":
+                    file = await open_input_file(os.path.join(target, filename), files)
                     media.append(
                         InputMediaPhoto(file) if compress else InputMediaDocument(file)
                     )      
-                elif suffix in [".mp4", ".mv4", ".f4v", ".lrv", ".mov"]:
+                elif media_type == "video":
+                    file = await open_input_file(os.path.join(target, filename), files)
                     media.append(
                         InputMediaVideo(file) if compress else InputMediaDocument(file)
                     )
-                elif suffix != ".txt":
+                elif media_type != "caption":
                     print(
                         f"Ignored {filename} in reply_media when handling message:\n{message.text}",
                         file = sys.stderr
@@ -482,49 +819,64 @@ async def reply_media(target: str, message: Message, compress: bool = True):
                         f"Ignored {sanitize_html_style(filename)} in reply_media when handling message:\n{sanitize_html_style(message.text)}",
                         message.get_bot()
                     )
-        except Exception as e:
-            errors += f"{traceback.format_exc()}\n"
-            errors_formatted += f"<pre><code class=\"language-log\">{sanitize_html_style(str(e))}</code></pre>\n"
-            errors_formatted_traceback += f"<pre><code class=\"language-log\">{sanitize_html_style(traceback.format_exc())}</code></pre>\n"
-    if errors:
-        print(
-            f"When constructing InputMedia objects, the following errors occured:\n{errors}\nThe handled message:\n{message.text}",
-            file = sys.stderr
-        )
-        await message.reply_html(
-            f"When constructing InputMedia objects, the following errors occured:\n{errors_formatted}"
-        )
-        await send_to_logging_chats(
-            f"When constructing InputMedia objects, the following errors occured:\n{errors_formatted_traceback}\nThe handled message:\n{sanitize_html_style(message.text)}",
-            message.get_bot()
-        )
+            except Exception as e:
+                formatted_traceback = traceback.format_exc()
+                errors += f"{formatted_traceback}\n"
+                errors_formatted += f"<pre><code class=\"language-log\">{sanitize_html_style(str(e))}</code></pre>\n"
+                # the sanitized traceback is only needed for the logging chats
+                if config["logging_chat_ids"]:
+                    errors_formatted_traceback += f"<pre><code class=\"language-log\">{sanitize_html_style(formatted_traceback)}</code></pre>\n"
+        if errors:
+            print(
+                f"When constructing InputMedia objects, the following errors occured:\n{errors}\nThe handled message:\n{message.text}",
+                file = sys.stderr
+            )
+            await message.reply_html(
+                f"When constructing InputMedia objects, the following errors occured:\n{errors_formatted}"
+            )
+            await send_to_logging_chats(
+                f"When constructing InputMedia objects, the following errors occured:\n{errors_formatted_traceback}\nThe handled message:\n{sanitize_html_style(message.text)}",
+                message.get_bot()
+            )
 
-    # a media group includes a maximum of 10 elements
-    if "file.txt" in filenames:
-        with open(os.path.join(target, "file.txt"), 'r', encoding='UTF-8') as caption_file:
-            caption = caption_file.read()
-            # message captions must be 0-1024 characters after entities parsing
-            caption = caption if len(caption) < 1024 else caption[:1023] + "…"
+        # a media group includes a maximum of 10 elements
+        groups = [media[i:i + 10] for i in range(0, len(media), 10)]
+        if groups:
+            caption = None
+            if "file.txt" in filenames:
+                caption = await asyncio.to_thread(read_caption, os.path.join(target, "file.txt"))
+            # the groups are sent one by one, so that they keep the order of the post; the first one has the caption
             await message.reply_media_group(
-                media[:10],
+                groups[0],
                 disable_notification = True,
                 caption = caption
             )
-            media = media[10:]
-    while media:
-        await message.reply_media_group(
-            media[:10],
-            disable_notification = True
-        )
-        media = media[10:]
+            for group in groups[1:]:
+                await message.reply_media_group(
+                    group,
+                    disable_notification = True
+                )
 
-    # remove target with all the files
-    shutil.rmtree(target)
+
+def extract_cover(filepath: str) -> Optional[io.BytesIO]:
+    """Return the cover of the MP3 file at `filepath` as a file-like object named ``cover.jpg``, or ``None`` if the file has no cover."""
+    # only the ID3 tag at the start of the file is read, without scanning the MPEG frames as MP3() does
+    try:
+        tags = ID3(filepath)
+    except ID3NoHeaderError:
+        return None
+    # the tag is set here: https://github.com/tombulled/python-youtube-music/blob/0817d2688db3615a884453c6482008dac9977bf3/ytm/apis/YouTubeMusicDL/YouTubeMusicDL.py# L167
+    apic_tag = tags.get("APIC:Cover")
+    if not apic_tag:
+        return None
+    thumb_file = io.BytesIO(apic_tag.data)
+    thumb_file.name = "cover.jpg"
+    return thumb_file
 
 
 async def reply_audios(target: str, message: Message):
     """
-    Reply to `message` with audios from `target`, then remove `target`.
+    Reply to `message` with audios from `target`.
 
     Reply with an error message in case of any errors.
 
@@ -535,91 +887,196 @@ async def reply_audios(target: str, message: Message):
     message : telegram.Message
         A Telegram message to reply to.
     """
-    filenames = sorted(
-        os.listdir(target),
-        key = lambda filename: os.path.getctime(os.path.join(target, filename))
-    )
+    filenames = await asyncio.to_thread(listdir_by_ctime, target)
+    audio_filenames = [filename for filename in filenames if MEDIA_TYPES.get(os.path.splitext(filename)[1].lower()) == "audio"]
+    # Telegram requires the cover to be passed as a separate file, so we need to extract it
+    covers = dict(zip(
+        audio_filenames,
+        await asyncio.gather(
+            *(asyncio.to_thread(extract_cover, os.path.join(target, filename)) for filename in audio_filenames),
+            return_exceptions = True
+        )
+    ))
             
-    audios = []
-    errors = ""
-    errors_formatted = ""
-    errors_formatted_traceback = ""
-    for filename in filenames:
-        filepath = os.path.join(target, filename)
-        suffix = pathlib.PurePath(filename).suffix
-        # see https://core.telegram.org/type/storage.FileType
-        if suffix in [".mp3"]:
-            # Telegram requires the cover to be passed as a separate file, so we need to extract it
-            thumb_file = None
-            try:
-                audio = MP3(filepath, ID3=ID3)
-                # the tag is set here: https://github.com/tombulled/python-youtube-music/blob/0817d2688db3615a884453c6482008dac9977bf3/ytm/apis/YouTubeMusicDL/YouTubeMusicDL.py# L167
-                apic_tag = audio.tags.get("APIC:Cover")
-                if apic_tag:
-                    thumb_file = io.BytesIO(apic_tag.data)
-                    thumb_file.name = "cover.jpg"
-            except Exception as e:
+    # the files are closed once the replies are sent
+    with ExitStack() as files:
+        audios = []
+        errors = ""
+        errors_formatted = ""
+        errors_formatted_traceback = ""
+        for filename in filenames:
+            filepath = os.path.join(target, filename)
+            media_type = MEDIA_TYPES.get(os.path.splitext(filename)[1].lower())
+            if media_type == "audio":
+                thumb_file = covers[filename]
+                if isinstance(thumb_file, Exception):
+                    e = thumb_file
+                    thumb_file = None
+                    formatted_traceback = "".join(traceback.format_exception(e))
+                    print(
+                        f"An error occured while preparing the cover for {filename}:\n{formatted_traceback}",
+                        file = sys.stderr
+                    )
+                    await message.reply_html(
+                        f"An error occured while preparing the cover for <code>{sanitize_html_style(filename)}</code>:\n<pre><code class=\"language-log\">{sanitize_html_style(str(e))}</code></pre>"
+                    )
+                    await send_to_logging_chats(
+                        f"An error occured while preparing the cover for <code>{sanitize_html_style(filename)}:\n<pre><code class=\"language-log\">{sanitize_html_style(formatted_traceback)}</code></pre>",
+                        message.get_bot()
+                    )
+                try:
+                    audios.append(
+                        InputMediaAudio(
+                            await open_input_file(filepath, files),
+                            thumbnail = thumb_file
+                        )
+                    )
+                except Exception as e:
+                    formatted_traceback = traceback.format_exc()
+                    errors += f"{formatted_traceback}\n"
+                    errors_formatted += f"<pre><code class=\"language-log\">{sanitize_html_style(str(e))}</code></pre>\n"
+                    # the sanitized traceback is only needed for the logging chats
+                    if config["logging_chat_ids"]:
+                        errors_formatted_traceback += f"<pre><code class=\"language-log\">{sanitize_html_style(formatted_traceback)}</code></pre>\n"
+            elif media_type != "caption":
                 print(
-                    f"An error occured while preparing the cover for {filename}:\n{traceback.format_exc()}",
+                    f"Ignored {filename} in reply_audio when handling message:\n{message.text}",
                     file = sys.stderr
                 )
-                await message.reply_html(
-                    f"An error occured while preparing the cover for <code>{sanitize_html_style(filename)}</code>:\n<pre><code class=\"language-log\">{sanitize_html_style(str(e))}</code></pre>"
-                )
                 await send_to_logging_chats(
-                    f"An error occured while preparing the cover for <code>{sanitize_html_style(filename)}:\n<pre><code class=\"language-log\">{sanitize_html_style(traceback.format_exc())}</code></pre>",
+                    f"Ignored {sanitize_html_style(filename)} in reply_audio when handling message:\n{sanitize_html_style(message.text)}",
                     message.get_bot()
                 )
-            try:
-                with open(filepath, 'rb') as file:
-                    audios.append(
-                        InputMediaAudio(
-                            file,
-                            thumbnail = thumb_file
-                        )
-                    )      
-            except Exception as e:
-                errors += f"{traceback.format_exc()}\n"
-                errors_formatted += f"<pre><code class=\"language-log\">{sanitize_html_style(str(e))}</code></pre>\n"
-                errors_formatted_traceback += f"<pre><code class=\"language-log\">{sanitize_html_style(traceback.format_exc())}</code></pre>\n"
-        elif suffix != ".txt":
+        if errors:
             print(
-                f"Ignored {filename} in reply_audio when handling message:\n{message.text}",
+                f"When constructing InputMediaAudio objects, the following errors occured:\n{errors}\nThe handled message:\n{message.text}",
                 file = sys.stderr
             )
+            await message.reply_html(
+                f"When constructing InputMediaAudio objects, the following errors occured:\n{errors_formatted}"
+            )
             await send_to_logging_chats(
-                f"Ignored {sanitize_html_style(filename)} in reply_audio when handling message:\n{sanitize_html_style(message.text)}",
+                f"When constructing InputMediaAudio objects, the following errors occured:\n{errors_formatted_traceback}\nThe handled message:\n{sanitize_html_style(message.text)}",
                 message.get_bot()
             )
-    if errors:
-        print(
-            f"When constructing InputMediaAudio objects, the following errors occured:\n{errors}\nThe handled message:\n{message.text}",
-            file = sys.stderr
-        )
-        await message.reply_html(
-            f"When constructing InputMediaAudio objects, the following errors occured:\n{errors_formatted}"
-        )
-        await send_to_logging_chats(
-            f"When constructing InputMediaAudio objects, the following errors occured:\n{errors_formatted_traceback}\nThe handled message:\n{sanitize_html_style(message.text)}",
-            message.get_bot()
-        )
 
-    # a media group includes a maximum of 10 elements
-    while audios:
-        try:
-            await message.reply_media_group(
-                audios[:10],
-                disable_notification = True
-            )
-        except Exception:
-            print(
-                f"An error occured when sendind an audio group:\n{traceback.format_exc()}",
-                file = sys.stderr
-            )
-        audios = audios[10:]
+        # a media group includes a maximum of 10 elements
+        while audios:
+            try:
+                await message.reply_media_group(
+                    audios[:10],
+                    disable_notification = True
+                )
+            except Exception:
+                print(
+                    f"An error occured when sendind an audio group:\n{traceback.format_exc()}",
+                    file = sys.stderr
+                )
+            audios = audios[10:]
+
 
-    # remove target with all the files
-    shutil.rmtree(target)
+def get_instaloader(chat_id: int) -> instaloader.Instaloader:
+    """Return the ``Instaloader`` to use in the chat with `chat_id`, depending on whether captions are disabled there."""
+    # no_captions_chat_ids changes at runtime, so the choice is not cached; the lookup is a set membership test
+    return L_no_captions if chat_id in no_captions_chat_ids else L_captions
+
+
+# how long get_story_batched() waits for other requests to fetch their stories together
+STORY_BATCH_DELAY = 0.2
+# the futures waiting for the stories of each userid, for each Instaloader; accessed from the event loop only, so no lock is needed
+pending_story_requests: dict[instaloader.Instaloader, dict[int, list[asyncio.Future]]] = {}
+# strong references to the running flush_story_requests() tasks, so that they are not garbage collected
+story_flush_tasks = set()
+# how long the fetched stories are reused, e.g. for several links to certain stories of the same profile in one message
+STORY_CACHE_TTL = 30
+# the stories fetched for each userid (None if there are none) and the time they were fetched at (see time.monotonic()), for each Instaloader; accessed from the event loop only
+story_cache: dict[instaloader.Instaloader, dict[int, tuple[Optional[Story], float]]] = {}
+
+
+async def flush_story_requests(L: instaloader.Instaloader):
+    """After ``STORY_BATCH_DELAY``, fetch the stories of all the userids pending for `L` with a single ``L.get_stories()`` call and resolve the waiting futures."""
+    await asyncio.sleep(STORY_BATCH_DELAY)
+    pending = pending_story_requests.pop(L)
+    try:
+        loop = asyncio.get_running_loop()
+        stories = await loop.run_in_executor(
+            instaloader_executor,
+            lambda: {story.owner_id: story for story in L.get_stories(list(pending))}
+        )
+    except Exception as e:
+        for futures in pending.values():
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+    else:
+        now = time.monotonic()
+        cache = story_cache.setdefault(L, {})
+        # the expired entries are dropped, so that the cache doesn't grow with every profile the bot has ever seen
+        for userid in [userid for userid, (_, fetched_at) in cache.items() if now - fetched_at > STORY_CACHE_TTL]:
+            del cache[userid]
+        for userid, futures in pending.items():
+            cache[userid] = (stories.get(userid), now)
+            for future in futures:
+                if not future.done():
+                    future.set_result(stories.get(userid))
+
+
+async def get_story_batched(L: instaloader.Instaloader, userid: int) -> Optional[Story]:
+    """
+    Return the current story of the profile with `userid`, or ``None`` if there is none.
+
+    The requests made within ``STORY_BATCH_DELAY`` are fetched together with a single ``L.get_stories()`` call (i.e., a single request to Instagram).
+    The fetched stories are reused for ``STORY_CACHE_TTL`` seconds.
+    """
+    cached = story_cache.get(L, {}).get(userid)
+    if cached is not None and time.monotonic() - cached[1] <= STORY_CACHE_TTL:
+        return cached[0]
+    future = asyncio.get_running_loop().create_future()
+    if L not in pending_story_requests:
+        pending_story_requests[L] = {}
+        task = asyncio.create_task(flush_story_requests(L))
+        story_flush_tasks.add(task)
+        task.add_done_callback(story_flush_tasks.discard)
+    pending_story_requests[L].setdefault(userid, []).append(future)
+    return await future
+
+
+# how long the profiles looked up by get_profile_cached() are reused
+PROFILE_CACHE_TTL = 60
+# the lookups of each username (futures, so that concurrent lookups of the same username make a single request) and the time they were started at (see time.monotonic()), for each InstaloaderContext; accessed from the event loop only
+profile_cache: dict[tuple[instaloader.InstaloaderContext, str], tuple[asyncio.Future, float]] = {}
+
+
+async def get_profile_cached(L: instaloader.Instaloader, username: str) -> Profile:
+    """
+    Return ``Profile.from_username(L.context, username)``.
+
+    The profiles are reused for ``PROFILE_CACHE_TTL`` seconds; the failed lookups are not.
+    """
+    now = time.monotonic()
+    key = (L.context, username.lower())
+    cached = profile_cache.get(key)
+    if cached is None or now - cached[1] > PROFILE_CACHE_TTL:
+        # the expired entries are dropped, so that the cache doesn't grow with every profile the bot has ever seen
+        for expired_key in [cache_key for cache_key, (_, started_at) in profile_cache.items() if now - started_at > PROFILE_CACHE_TTL]:
+            del profile_cache[expired_key]
+        future = asyncio.get_running_loop().run_in_executor(
+            instaloader_executor,
+            # Profile.from_username(L.context, username)
+            Profile.from_username,
+            L.context,
+            username
+        )
+        profile_cache[key] = (future, now)
+    else:
+        future = cached[0]
+    try:
+        # shielded, so that cancelling one of the waiting tasks doesn't cancel the lookup for the others
+        return await asyncio.shield(future)
+    except Exception:
+        if profile_cache.get(key, (None,))[0] is future:
+            del profile_cache[key]
+        raise
 
 
 async def download_post_and_reply(shortcode: str, message: Message, compress: bool = True):
@@ -638,156 +1095,54 @@ async def download_post_and_reply(shortcode: str, message: Message, compress: bo
     compress : bool, optional
         Whether to compress the downloaded images and videos when sending. Passed to ``reply_media()``. Default is ``True``.
     """
-    try:
-        await message.reply_chat_action('typing')
-    except Exception:
-        print(
-            f"Failed to set chat action:\n{traceback.format_exc()}",
-            file = sys.stderr
-        )
+    await send_chat_action(message, 'typing')
     
-    L = L_captions if message.chat.id not in no_captions_chat_ids else L_no_captions
+    L = get_instaloader(message.chat.id)
+    loop = asyncio.get_running_loop()
     try:
-        loop = asyncio.get_running_loop()
         post_from_shortcode_task = loop.run_in_executor(
-            None,
+            instaloader_executor,
             # instaloader.Post.from_shortcode(L.context, shortcode)
             instaloader.Post.from_shortcode,
             L.context,
             shortcode
         )
-        post_from_shortcode_task = asyncio.ensure_future(post_from_shortcode_task)
-
-        reply_chat_action_task = asyncio.create_task(
-            repeat_until_task_done(
-                5,  # see https://core.telegram.org/bots/api#sendchataction
-                post_from_shortcode_task,
-                # message.reply_chat_action('typing')
-                message.reply_chat_action,
-                'typing'
-            )
-        )
-        
-        post = await post_from_shortcode_task
-        await reply_chat_action_task
+
+        post = await await_with_chat_action(post_from_shortcode_task, message, 'typing')
     except AbortDownloadException as e:
         try:
-            print(
-                f"A critical error occured when retrieving the post:\n{traceback.format_exc()}\nThe determined shortcode: {shortcode}",
-                file = sys.stderr
-            )
-            await message.reply_html(
-                f"A critical error occured when retrieving the post."
-            )
-            await send_to_logging_chats(
-                f"A critical error occured when retrieving the post:\n<pre><code class=\"language-log\">{sanitize_html_style(traceback.format_exc())}</code></pre>\nThe determined shortcode: <code>{sanitize_html_style(shortcode)}</code>",
-                message.get_bot()
-            )
+            await report_error(message, "retrieving the post", shortcode, e)
         finally:
-            future = await feature_state.set("inst", False)
-            await future
-            future = await feature_state.backup()
-            await future
-            await send_to_active_chats(config["messages"]["notifications"]["feature_disabled"], message.get_bot(), feature = FEATURE_NAMES["inst"])
-            await send_to_logging_chats(config["messages"]["notifications"]["feature_disabled"], message.get_bot(), feature = FEATURE_NAMES["inst"])
+            await disable_feature("inst", message.get_bot())
     except Exception as e:
-        print(
-            f"An error occured when retrieving the post:\n{traceback.format_exc()}\nThe determined shortcode: {shortcode}",
-            file = sys.stderr
-        )
-        await message.reply_html(
-            f"An error occured when retrieving the post:\n<pre><code class=\"language-log\">{sanitize_html_style(str(e))}</code></pre>\nThe determined shortcode: <code>{sanitize_html_style(shortcode)}</code>"
-        )
-        await send_to_logging_chats(
-            f"An error occured when retrieving the post:\n<pre><code class=\"language-log\">{sanitize_html_style(traceback.format_exc())}</code></pre>\nThe determined shortcode: <code>{sanitize_html_style(shortcode)}</code>",
-            message.get_bot()
-        )
+        await report_error(message, "retrieving the post", shortcode, e)
     else:
-        target = str(message.chat.id) + "-" + str(message.id) + "-post-" + shortcode
-        try:
-            loop = asyncio.get_running_loop()
-            download_post_task = loop.run_in_executor(
-                None,
-                # L.download_post(post, target)
-                L.download_post,
-                post,
-                target
-            )
-            download_post_task = asyncio.ensure_future(download_post_task)
-
-            reply_chat_action_task = asyncio.create_task(
-                repeat_until_task_done(
-                    5,  # see https://core.telegram.org/bots/api#sendchataction
-                    download_post_task,
-                    # message.reply_chat_action('typing')
-                    message.reply_chat_action,
-                    'typing'
-                )
-            )
-            
-            await download_post_task
-            await reply_chat_action_task
-        except AbortDownloadException as e:
-            try:
-                print(
-                    f"A critical error occured when downloading the post {shortcode}:\n{traceback.format_exc()}",
-                    file = sys.stderr
-                )
-                await message.reply_html(
-                    f"A critical error occured when downloading the post <code>{sanitize_html_style(shortcode)}</code>."
-                )
-                await send_to_logging_chats(
-                    f"A critical error occured when downloading the post <code>{sanitize_html_style(shortcode)}</code>:\n<pre><code class=\"language-log\">{sanitize_html_style(traceback.format_exc())}</code></pre>",
-                    message.get_bot()
-                )
-            finally:
-                future = await feature_state.set("inst", False)
-                await future
-                future = await feature_state.backup()
-                await future
-                await send_to_active_chats(config["messages"]["notifications"]["feature_disabled"], message.get_bot(), feature = FEATURE_NAMES["inst"])
-                await send_to_logging_chats(config["messages"]["notifications"]["feature_disabled"], message.get_bot(), feature = FEATURE_NAMES["inst"])
-        except Exception as e:
-            print(
-                f"An error occured when downloading the post {shortcode}:\n{traceback.format_exc()}",
-                file = sys.stderr
-            )
-            await message.reply_html(
-                f"An error occured when downloading the post <code>{sanitize_html_style(shortcode)}</code>:\n<pre><code class=\"language-log\">{sanitize_html_style(str(e))}</code></pre>"
-            )
-            await send_to_logging_chats(
-                f"An error occured when downloading the post <code>{sanitize_html_style(shortcode)}</code>:\n<pre><code class=\"language-log\">{sanitize_html_style(traceback.format_exc())}</code></pre>",
-                message.get_bot()
-            )
-        else:
+        async with download_directory(f"{message.chat.id}-{message.id}-post-{shortcode}") as target:
             try:
-                await message.reply_chat_action('upload_document')
-            except Exception:
-                print(
-                    f"Failed to set chat action:\n{traceback.format_exc()}",
-                    file = sys.stderr
+                download_post_task = loop.run_in_executor(
+                    instaloader_executor,
+                    # L.download_post(post, target)
+                    L.download_post,
+                    post,
+                    target
                 )
-            
-            reply_media_task = asyncio.create_task(
-                reply_media(target, message, compress)
-            )
 
-            reply_chat_action_task = asyncio.create_task(
-                repeat_until_task_done(
-                    5,  # see https://core.telegram.org/bots/api#sendchataction
-                    reply_media_task,
-                    # message.reply_chat_action('upload_document')
-                    message.reply_chat_action,
-                    'upload_document'
-                )
-            )
+                await await_with_chat_action(download_post_task, message, 'typing')
+            except AbortDownloadException as e:
+                try:
+                    await report_error(message, "downloading the post", shortcode, e)
+                finally:
+                    await disable_feature("inst", message.get_bot())
+            except Exception as e:
+                await report_error(message, "downloading the post", shortcode, e)
+            else:
+                await send_chat_action(message, 'upload_document')
             
-            await reply_media_task
-            await reply_chat_action_task
-        finally:
-            await reply_chat_action_task
-            # remove target with all the files, if any were created
-            shutil.rmtree(target, ignore_errors = True)
+                reply_media_task = asyncio.create_task(
+                    reply_media(target, message, compress)
+                )
+
+                await await_with_chat_action(reply_media_task, message, 'upload_document')
 
 
 async def download_storyitem_and_reply(story_item: StoryItem, message: Message, compress: bool = True):
@@ -806,107 +1161,97 @@ async def download_storyitem_and_reply(story_item: StoryItem, message: Message,
     compress : bool, optional
         Whether to compress the downloaded image or video when sending. Passed to ``reply_media()``. Default is ``True``.
     """
-    try:
-        await message.reply_chat_action('typing')
-    except Exception:
-        print(
-            f"Failed to set chat action:\n{traceback.format_exc()}",
-            file = sys.stderr
-        )
+    await send_chat_action(message, 'typing')
     
-    L = L_captions if message.chat.id not in no_captions_chat_ids else L_no_captions
-    target = str(message.chat.id) + "-" + str(message.id) + "-story-" + str(story_item.mediaid)
-    try:
-        loop = asyncio.get_running_loop()
-        download_storyitem_task = loop.run_in_executor(
-            None,
-            # L.download_storyitem(story_item, target)
-            L.download_storyitem,
-            story_item,
-            target
-        )
-        download_storyitem_task = asyncio.ensure_future(download_storyitem_task)
-
-        reply_chat_action_task = asyncio.create_task(
-            repeat_until_task_done(
-                5,  # see https://core.telegram.org/bots/api#sendchataction
-                download_storyitem_task,
-                # message.reply_chat_action('typing')
-                message.reply_chat_action,
-                'typing'
-            )
-        )
-        
-        await download_storyitem_task
-        await reply_chat_action_task
-    except AbortDownloadException as e:
-        try:
-            print(
-                f"A critical error occured when downloading the story {story_item.mediaid}:\n{traceback.format_exc()}",
-                file = sys.stderr
-            )
-            await message.reply_html(
-                f"A critical error occured when downloading the story <code>{sanitize_html_style(story_item.mediaid)}</code>."
-            )
-            await send_to_logging_chats(
-                f"A critical error occured when downloading the story <code>{sanitize_html_style(story_item.mediaid)}</code>:\n<pre><code class=\"language-log\">{sanitize_html_style(traceback.format_exc())}</code></pre>",
-                message.get_bot()
-            )
-        finally:
-            future = await feature_state.set("inst", False)
-            await future
-            future = await feature_state.backup()
-            await future
-            await send_to_active_chats(config["messages"]["notifications"]["feature_disabled"], message.get_bot(), feature = FEATURE_NAMES["inst"])
-            await send_to_logging_chats(config["messages"]["notifications"]["feature_disabled"], message.get_bot(), feature = FEATURE_NAMES["inst"])
-    except Exception as e:
-        print(
-            f"An error occured when downloading the story {story_item.mediaid}:\n{traceback.format_exc()}",
-            file = sys.stderr
-        )
-        await message.reply_html(
-            f"An error occured when downloading the story <code>{sanitize_html_style(story_item.mediaid)}</code>:\n<pre><code class=\"language-log\">{sanitize_html_style(str(e))}</code></pre>"
-        )
-        await send_to_logging_chats(
-            f"An error occured when downloading the story <code>{sanitize_html_style(story_item.mediaid)}</code>:\n<pre><code class=\"language-log\">{sanitize_html_style(traceback.format_exc())}</code></pre>",
-            message.get_bot()
-        )
-    else:
+    L = get_instaloader(message.chat.id)
+    async with download_directory(f"{message.chat.id}-{message.id}-story-{story_item.mediaid}") as target:
         try:
-            await message.reply_chat_action('upload_document')
-        except Exception:
-            print(
-                f"Failed to set chat action:\n{traceback.format_exc()}",
-                file = sys.stderr
+            loop = asyncio.get_running_loop()
+            download_storyitem_task = loop.run_in_executor(
+                instaloader_executor,
+                # L.download_storyitem(story_item, target)
+                L.download_storyitem,
+                story_item,
+                target
             )
+
+            await await_with_chat_action(download_storyitem_task, message, 'typing')
+        except AbortDownloadException as e:
+            try:
+                await report_error(message, "downloading the story", story_item.mediaid, e)
+            finally:
+                await disable_feature("inst", message.get_bot())
+        except Exception as e:
+            await report_error(message, "downloading the story", story_item.mediaid, e)
+        else:
+            await send_chat_action(message, 'upload_document')
             
-        reply_media_task = asyncio.create_task(
-            reply_media(target, message, compress)
-        )
+            reply_media_task = asyncio.create_task(
+                reply_media(target, message, compress)
+            )
 
-        reply_chat_action_task = asyncio.create_task(
-            repeat_until_task_done(
-                5,  # see https://core.telegram.org/bots/api#sendchataction
-                reply_media_task,
-                # message.reply_chat_action('upload_document')
-                message.reply_chat_action,
-                'upload_document'
+            await await_with_chat_action(reply_media_task, message, 'upload_document')
+
+
+# the number of story items downloaded and sent together (a media group includes a maximum of 10 elements)
+STORY_BATCH_SIZE = 10
+
+
+def flatten_item_directories(target: str):
+    """Move the files from each subdirectory of `target` to `target`, prefixing their names with the name of the subdirectory (so that they keep its order), and remove the subdirectories."""
+    if not os.path.isdir(target):
+        return
+    for item_dir in os.listdir(target):
+        item_path = os.path.join(target, item_dir)
+        for filename in os.listdir(item_path):
+            os.replace(os.path.join(item_path, filename), os.path.join(target, f"{item_dir}-{filename}"))
+        os.rmdir(item_path)
+
+
+async def download_profile_stories(L: instaloader.Instaloader, profile: Profile, target: str, batches: asyncio.Queue):
+    """
+    Download all the current stories from `profile` to subdirectories of `target`, ``STORY_BATCH_SIZE`` story items per subdirectory.
+
+    Put the path of each subdirectory into `batches` as soon as it is downloaded, so that it can be sent while the next one is being downloaded, and finally put ``None``.
+    Unlike ``L.download_stories()``, download the story items of a batch concurrently (bounded by ``instaloader_executor``), each to its own subdirectory, which is flattened once the batch is downloaded.
+    When all the downloads of a batch are finished, raise the first error, if any, preferring ``AbortDownloadException``.
+    """
+    try:
+        story = await get_story_batched(L, profile.userid)
+        story_items = list(story.get_items()) if story else []
+        loop = asyncio.get_running_loop()
+        for start in range(0, len(story_items), STORY_BATCH_SIZE):
+            batch_target = os.path.join(target, f"{start // STORY_BATCH_SIZE:03}")
+            results = await asyncio.gather(
+                *(
+                    # L.download_storyitem(story_item, os.path.join(batch_target, f"{index:02}"))
+                    # each item gets its own directory, as instaloader names the files of concurrent downloads independently (all of them "file")
+                    loop.run_in_executor(instaloader_executor, L.download_storyitem, story_item, os.path.join(batch_target, f"{index:02}"))
+                    for index, story_item in enumerate(story_items[start:start + STORY_BATCH_SIZE])
+                ),
+                return_exceptions = True
             )
-        )
-            
-        await reply_media_task
-        await reply_chat_action_task
+            errors = [result for result in results if isinstance(result, Exception)]
+            if errors:
+                raise next((error for error in errors if isinstance(error, AbortDownloadException)), errors[0])
+            await asyncio.to_thread(flatten_item_directories, batch_target)
+            await batches.put(batch_target)
     finally:
-        await reply_chat_action_task
-        # remove target with all the files, if any were created
-        shutil.rmtree(target, ignore_errors = True)
+        await batches.put(None)
+
+
+async def reply_media_batches(batches: asyncio.Queue, message: Message, compress: bool = True):
+    """Call ``reply_media()`` for each directory taken from `batches`, in order, until ``None`` is taken. Each directory is removed once it is sent."""
+    while (batch_target := await batches.get()) is not None:
+        async with removing_directory(batch_target):
+            await reply_media(batch_target, message, compress)
 
 
 async def download_stories_and_reply(profile: Profile, message: Message, compress: bool = True):
     """
     Download all the stories from `profile` and reply with them.
 
-    Use ``instaloader`` to download stories from `profile`, then call ``reply_media()``.
+    Use ``instaloader`` to download stories from `profile` in batches, and call ``reply_media()`` for each batch while the next one is being downloaded.
     Set the corresponding chat actions. Reply with an error message in case of any errors. Remove the downloaded files before finishing working.
 
     Parameters
@@ -918,259 +1263,147 @@ async def download_stories_and_reply(profile: Profile, message: Message, compres
     compress : bool, optional
         Whether to compress the downloaded images and videos when sending. Passed to ``reply_media()``. Default is ``True``.
     """
-    try:
-        await message.reply_chat_action('typing')
-    except Exception:
-        print(
-            f"Failed to set chat action:\n{traceback.format_exc()}",
-            file = sys.stderr
-        )
+    await send_chat_action(message, 'typing')
     
-    L = L_captions if message.chat.id not in no_captions_chat_ids else L_no_captions
-    target = str(message.chat.id) + "-" + str(message.id) + "-stories-" + str(profile.userid)
-    try:
-        loop = asyncio.get_running_loop()
-        download_stories_with_arguments = partial(
-            # L.download_stories([profile], filename_target = target)
-            L.download_stories,
-            [profile],
-            filename_target = target
+    L = get_instaloader(message.chat.id)
+    async with download_directory(f"{message.chat.id}-{message.id}-stories-{profile.userid}") as target:
+        # the queue is not bounded, so that the downloads never wait for a failed reply
+        batches = asyncio.Queue()
+        reply_media_batches_task = asyncio.create_task(
+            reply_media_batches(batches, message, compress)
         )
-        download_stories_task = loop.run_in_executor(
-            None,
-            # keyword arguments are not supported
-            download_stories_with_arguments
+        download_stories_task = asyncio.create_task(
+            download_profile_stories(L, profile, target, batches)
         )
-        download_stories_task = asyncio.ensure_future(download_stories_task)
-
-        reply_chat_action_task = asyncio.create_task(
-            repeat_until_task_done(
-                5,  # see https://core.telegram.org/bots/api#sendchataction
-                download_stories_task,
-                # message.reply_chat_action('typing')
-                message.reply_chat_action,
-                'typing'
-            )
+        # if sending fails (e.g. the bot was removed from the chat), the rest of the stories are not downloaded
+        reply_media_batches_task.add_done_callback(
+            lambda task: task.cancelled() or task.exception() is None or download_stories_task.cancel()
         )
-        
-        await download_stories_task
-        await reply_chat_action_task
-    except AbortDownloadException as e:
         try:
-            print(
-                f"A critical error occured when downloading stories for the profile {profile.username}:\n{traceback.format_exc()}",
-                file = sys.stderr
-            )
-            await message.reply_html(
-                f"A critical error occured when downloading stories for the profile <code>{sanitize_html_style(profile.username)}</code>."
-            )
-            await send_to_logging_chats(
-                f"A critical error occured when downloading stories for the profile <code>{sanitize_html_style(profile.username)}</code>:\n<pre><code class=\"language-log\">{sanitize_html_style(traceback.format_exc())}</code></pre>",
-                message.get_bot()
-            )
+            await await_with_chat_action(download_stories_task, message, 'typing')
+        except asyncio.CancelledError:
+            # the error of the replies is raised below; the cancellation of this task itself is propagated
+            if asyncio.current_task().cancelling():
+                raise
+        except AbortDownloadException as e:
+            try:
+                await report_error(message, "downloading stories for the profile", profile.username, e)
+            finally:
+                await disable_feature("inst", message.get_bot())
+        except Exception as e:
+            await report_error(message, "downloading stories for the profile", profile.username, e)
         finally:
-            future = await feature_state.set("inst", False)
-            await future
-            future = await feature_state.backup()
-            await future
-            await send_to_active_chats(config["messages"]["notifications"]["feature_disabled"], message.get_bot(), feature = FEATURE_NAMES["inst"])
-            await send_to_logging_chats(config["messages"]["notifications"]["feature_disabled"], message.get_bot(), feature = FEATURE_NAMES["inst"])
-    except Exception as e:
-        print(
-            f"An error occured when downloading stories for the profile {profile.username}:\n{traceback.format_exc()}",
-            file = sys.stderr
-        )
-        await message.reply_html(
-            f"An error occured when downloading stories for the profile <code>{sanitize_html_style(profile.username)}</code>:\n<pre><code class=\"language-log\">{sanitize_html_style(str(e))}</code></pre>"
-        )
-        await send_to_logging_chats(
-            f"An error occured when downloading stories for the profile <code>{sanitize_html_style(profile.username)}</code>:\n<pre><code class=\"language-log\">{sanitize_html_style(traceback.format_exc())}</code></pre>",
-            message.get_bot()
-        )
-    else:
-        try:
-            await message.reply_chat_action('upload_document')
-        except Exception:
-            print(
-                f"Failed to set chat action:\n{traceback.format_exc()}",
-                file = sys.stderr
-            )
-            
-        reply_media_task = asyncio.create_task(
-            reply_media(target, message, compress)
-        )
+            # the batches downloaded before an error are sent anyway
+            await await_with_chat_action(reply_media_batches_task, message, 'upload_document')
 
-        reply_chat_action_task = asyncio.create_task(
-            repeat_until_task_done(
-                5,  # see https://core.telegram.org/bots/api#sendchataction
-                reply_media_task,
-                # message.reply_chat_action('upload_document')
-                message.reply_chat_action,
-                'upload_document'
-            )
-        )
-            
-        await reply_media_task
-        await reply_chat_action_task
-    finally:
-        await reply_chat_action_task
-        # remove target with all the files, if any were created
-        shutil.rmtree(target, ignore_errors = True)
 
+def cancellation_hook(cancel_event: threading.Event) -> Callable:
+    """Return a yt-dlp progress hook that raises ``yt_dlp.utils.DownloadCancelled`` once `cancel_event` is set."""
+    def hook(status: dict):
+        if cancel_event.is_set():
+            raise yt_dlp.utils.DownloadCancelled()
+    return hook
 
-def create_ytml_and_download_song(song_id, directory):
-    """
-    Call ``YouTubeMusicDL.download_song`` with certain parameters.
 
-    The parameters passed to ``yt_dlp.YoutubeDL``:
-    ``ffmpeg_location = env("FFMPEG_LOCATION")``
-    ``no_warnings = True``
-    ``noprogress = True``
+# the process the YouTube cookie file was resolved in, its local path (or None if there is none) and the time it was resolved at (see time.monotonic()); worker processes may inherit it, so it is checked against os.getpid()
+youtube_cookies_cache: Optional[tuple[int, Optional[str], float]] = None
+youtube_cookies_lock = threading.Lock()
+# for how long (in seconds) the local copy of the YouTube cookie file from STATE_BUCKET is used
+YOUTUBE_COOKIES_TTL = 600
+# the process the private directory for the local copies of the YouTube cookie file was created in, and its path
+# the private directory (accessible by the current user only) for the local copies of the YouTube cookie file; created by setup() in the main process and removed by post_shutdown(), as the worker processes are terminated without cleaning up
+youtube_cookies_dir: Optional[str] = None
 
-    Parameters
-    ----------
-    song_id : str
-        An id of the song to download, e.g. ``dQw4w9WgXcQ``.
-    directory
-        Either a string representing a path segment, or an object implementing the ``os.PathLike`` interface where the ``__fspath__()`` method returns a string, such as another path object.
-        Used as an argument of https://docs.python.org/3/library/pathlib.html#pathlib.Path
+
+def get_youtube_cookiefile(cookies_dir: Optional[str]) -> Optional[str]:
     """
-    ytml = YouTubeMusicDL(youtube_downloader = yt_dlp.YoutubeDL)
-    
-    # Merge https://github.com/tombulled/python-youtube-music/pull/30
-    # Merge https://github.com/tombulled/python-youtube-music/pull/32
-    if env("STATE_BUCKET", default = None):
-        blob = BUCKET.blob(os.path.join("settings", "youtube_cookies.txt"))
-        cookiefile_exists = blob.exists()
-        cookiefile = blob.open(mode = "rt", encoding = "utf-8")
-    else:
+    Return the path of the YouTube cookie file (``settings/youtube_cookies.txt``), or ``None`` if there is none.
+
+    With ``STATE_BUCKET``, the file is downloaded to a private local copy in `cookies_dir` (``youtube_cookies_dir`` of the main process) at most once per ``YOUTUBE_COOKIES_TTL`` seconds in each process.
+    """
+    global youtube_cookies_cache
+
+    if not STATE_BUCKET:
         cookie_path = os.path.join(DIR, "settings", "youtube_cookies.txt")
-        cookiefile_exists = os.path.isfile(cookie_path)
-        cookiefile = cookie_path
-    if cookiefile_exists:
-        ytml.download_song(
-            song_id,
-            directory = directory,
-            ffmpeg_location = env("FFMPEG_LOCATION"),
-            cookiefile = cookiefile,
-            no_warnings = True,
-            noprogress = True,
-            # we can't pass a custom logger that calls send_to_logging_chats(), as application.bot is not picklable
-        )
-    else:
-        ytml.download_song(
-            song_id,
-            directory = directory,
-            ffmpeg_location = env("FFMPEG_LOCATION"),
-            no_warnings = True,
-            noprogress = True,
-            # we can't pass a custom logger that calls send_to_logging_chats(), as application.bot is not picklable
-        )
+        return cookie_path if os.path.isfile(cookie_path) else None
+    with youtube_cookies_lock:
+        if youtube_cookies_cache is None or youtube_cookies_cache[0] != os.getpid() or time.monotonic() - youtube_cookies_cache[2] > YOUTUBE_COOKIES_TTL:
+            blob = BUCKET.blob(os.path.join("settings", "youtube_cookies.txt"))
+            if blob.exists() and cookies_dir:
+                cookie_path = os.path.join(cookies_dir, "youtube_cookies.txt")
+                # mkstemp() creates the file with 0600 permissions, which download_to_filename() keeps; the copy may be in use by running downloads (of any process), so it is replaced atomically
+                fd, tmp_path = tempfile.mkstemp(suffix = ".tmp", dir = cookies_dir)
+                os.close(fd)
+                try:
+                    blob.download_to_filename(tmp_path)
+                    os.replace(tmp_path, cookie_path)
+                except BaseException:
+                    os.unlink(tmp_path)
+                    raise
+            else:
+                cookie_path = None
+            youtube_cookies_cache = (os.getpid(), cookie_path, time.monotonic())
+        return youtube_cookies_cache[1]
 
 
-def create_ytml_and_download_album(album_id, directory):
-    """
-    Call ``YouTubeMusicDL.download_album`` with certain parameters.
+# the YouTubeMusicDL instance of each thread that runs create_ytml_and_download() (including the main threads of the worker processes)
+ytml_local = threading.local()
 
-    The parameters passed to ``yt_dlp.YoutubeDL``:
-    ``ffmpeg_location = env("FFMPEG_LOCATION")``
-    ``no_warnings = True``
-    ``noprogress = True``
-    ``download_archive = os.path.join(directory, "download_archive.txt")``
 
-    Parameters
-    ----------
-    album_id : str
-        An id of the album to download, e.g. ``OLAK5uy_nmDUsWOMoEcz0SsVqUwir0oxu-k1oUyXE``.
-    directory
-        Either a string representing a path segment, or an object implementing the ``os.PathLike`` interface where the ``__fspath__()`` method returns a string, such as another path object.
-        Used as an argument of https://docs.python.org/3/library/pathlib.html#pathlib.Path
-    """
-    ytml = YouTubeMusicDL(youtube_downloader = yt_dlp.YoutubeDL)
-    
-    # Merge https://github.com/tombulled/python-youtube-music/pull/30
-    # Merge https://github.com/tombulled/python-youtube-music/pull/32
-    if env("STATE_BUCKET", default = None):
-        blob = BUCKET.blob(os.path.join("settings", "youtube_cookies.txt"))
-        cookiefile_exists = blob.exists()
-        cookiefile = blob.open(mode = "rt", encoding = "utf-8")
-    else:
-        cookie_path = os.path.join(DIR, "settings", "youtube_cookies.txt")
-        cookiefile_exists = os.path.isfile(cookie_path)
-        cookiefile = cookie_path
-    if cookiefile_exists:
-        ytml.download_album(
-            album_id,
-            directory = directory,
-            ffmpeg_location = env("FFMPEG_LOCATION"),
-            cookiefile = cookiefile,
-            no_warnings = True,
-            noprogress = True,
-            download_archive = os.path.join(directory, "download_archive.txt"),
-            # we can't pass a custom logger that calls send_to_logging_chats(), as application.bot is not picklable
-        )
-    else:
-        ytml.download_album(
-            album_id,
-            directory = directory,
-            ffmpeg_location = env("FFMPEG_LOCATION"),
-            no_warnings = True,
-            noprogress = True,
-            download_archive = os.path.join(directory, "download_archive.txt"),
-            # we can't pass a custom logger that calls send_to_logging_chats(), as application.bot is not picklable
-        )
+def get_ytml() -> YouTubeMusicDL:
+    """Return the ``YouTubeMusicDL`` of the current thread, creating it on the first call, so that its initialization is not repeated for every download."""
+    ytml = getattr(ytml_local, "ytml", None)
+    if ytml is None:
+        ytml = ytml_local.ytml = YouTubeMusicDL(youtube_downloader = yt_dlp.YoutubeDL)
+    return ytml
 
 
-def create_ytml_and_download_video(video_id, directory):
+def create_ytml_and_download(kind: str, item_id: str, directory, cookies_dir: Optional[str] = None, cancel_event: Optional[threading.Event] = None):
     """
-    Call ``YouTubeMusicDL.download_video`` with certain parameters.
+    Call ``YouTubeMusicDL.download_song``, ``YouTubeMusicDL.download_album`` or ``YouTubeMusicDL.download_video`` with certain parameters.
 
     The parameters passed to ``yt_dlp.YoutubeDL``:
-    ``ffmpeg_location = env("FFMPEG_LOCATION")``
+    ``ffmpeg_location = FFMPEG_LOCATION``
+    ``cookiefile = get_youtube_cookiefile(cookies_dir)``, if there is a cookie file
     ``no_warnings = True``
     ``noprogress = True``
+    ``download_archive = os.path.join(directory, "download_archive.txt")``, unless `kind` is ``'song'``
 
     Parameters
     ----------
-    video_id : str
-        An id of the video to download, e.g. ``dQw4w9WgXcQ``.
+    kind : str
+        What to download. Must be 'song', 'album' or 'video'.
+    item_id : str
+        An id of the item to download, e.g. ``dQw4w9WgXcQ`` (a song or a video) or ``OLAK5uy_nmDUsWOMoEcz0SsVqUwir0oxu-k1oUyXE`` (an album).
     directory
         Either a string representing a path segment, or an object implementing the ``os.PathLike`` interface where the ``__fspath__()`` method returns a string, such as another path object.
         Used as an argument of https://docs.python.org/3/library/pathlib.html#pathlib.Path
+    cookies_dir : str, optional
+        The directory for the local copy of the cookie file, i.e. ``youtube_cookies_dir`` of the main process (the worker processes don't share its globals).
+    cancel_event : threading.Event, optional
+        If given, the download is cancelled with ``yt_dlp.utils.DownloadCancelled`` at the next progress update after the event is set. Can't be passed to another process.
     """
-    ytml = YouTubeMusicDL(youtube_downloader = yt_dlp.YoutubeDL)
+    ytml = get_ytml()
     
     # Merge https://github.com/tombulled/python-youtube-music/pull/30
     # Merge https://github.com/tombulled/python-youtube-music/pull/32
-    if env("STATE_BUCKET", default = None):
-        blob = BUCKET.blob(os.path.join("settings", "youtube_cookies.txt"))
-        cookiefile_exists = blob.exists()
-        cookiefile = blob.open(mode = "rt", encoding = "utf-8")
-    else:
-        cookie_path = os.path.join(DIR, "settings", "youtube_cookies.txt")
-        cookiefile_exists = os.path.isfile(cookie_path)
-        cookiefile = cookie_path
-    if cookiefile_exists:
-        ytml.download_video(
-            video_id,
-            directory = directory,
-            ffmpeg_location = env("FFMPEG_LOCATION"),
-            cookiefile = cookiefile,
-            no_warnings = True,
-            noprogress = True,
-            download_archive = os.path.join(directory, "download_archive.txt"),
-            # we can't pass a custom logger that calls send_to_logging_chats(), as application.bot is not picklable
-        )
-    else:
-        ytml.download_video(
-            video_id,
-            directory = directory,
-            ffmpeg_location = env("FFMPEG_LOCATION"),
-            no_warnings = True,
-            noprogress = True,
-            download_archive = os.path.join(directory, "download_archive.txt"),
-            # we can't pass a custom logger that calls send_to_logging_chats(), as application.bot is not picklable
-        )
+    ydl_options = {
+        "ffmpeg_location": FFMPEG_LOCATION,
+        "no_warnings": True,
+        "noprogress": True,
+        "progress_hooks": [cancellation_hook(cancel_event)] if cancel_event else [],
+        # we can't pass a custom logger that calls send_to_logging_chats(), as application.bot is not picklable
+    }
+    cookiefile = get_youtube_cookiefile(cookies_dir)
+    if cookiefile:
+        ydl_options["cookiefile"] = cookiefile
+    if kind != "song":
+        ydl_options["download_archive"] = os.path.join(directory, "download_archive.txt")
+    getattr(ytml, f"download_{kind}")(
+        item_id,
+        directory = directory,
+        **ydl_options
+    )
 
 
 async def download_yt_and_reply(id: str, type: str, message: Message, compress = True):
@@ -1196,63 +1429,47 @@ async def download_yt_and_reply(id: str, type: str, message: Message, compress =
     if type not in ["audio", "album", "short"]:
         return
     
-    try:
-        await message.reply_chat_action('typing')
-    except Exception:
-        print(
-            f"Failed to set chat action:\n{traceback.format_exc()}",
-            file = sys.stderr
-        )
-
-    target = str(message.chat.id) + "-" + str(message.id) + "-audio-" + id
-    worth_trying = True
-    try_count = 0
-    MAX_TRY_COUNT = 3
-    TIMEOUT = config_context[type]
-    exitcode = 1
-    try:
-        while worth_trying:
-            try:
-                await message.reply_chat_action('typing')
-            except Exception:
-                print(
-                    f"Failed to set chat action:\n{traceback.format_exc()}",
-                    file = sys.stderr
-                )
-            try_count += 1
-            worth_trying = False
-            try:
-                if type == "audio":
-                    download_process = multiprocessing.Process(
-                        target = create_ytml_and_download_song,
-                        args = (id, target)
-                    )
-                elif type == "album":
-                    download_process = multiprocessing.Process(
-                        target = create_ytml_and_download_album,
-                        args = (id, target)
-                    )
-                else:  # type == "short"
-                    download_process = multiprocessing.Process(
-                        target = create_ytml_and_download_video,
-                        args = (id, target)
-                    )
-                download_process.start()
-                    
-                reply_chat_action_task = asyncio.create_task(
-                    repeat_while_process_alive(
-                        5,  # see https://core.telegram.org/bots/api#sendchataction
-                        download_process,
-                        # message.reply_chat_action('typing')
-                        message.reply_chat_action,
+    await send_chat_action(message, 'typing')
+
+    async with download_directory(f"{message.chat.id}-{message.id}-{type}-{id}") as target:
+        worth_trying = True
+        try_count = 0
+        attempt_count = 0
+        MAX_TRY_COUNT = 3
+        TIMEOUT = config_context[type]
+        # what create_ytml_and_download() should download for the type
+        kind = {"audio": "song", "album": "album", "short": "video"}[type]
+        # once half of the threads are held by timed out downloads, the first attempts go to the worker processes, which can be terminated
+        use_thread = timed_out_yt_threads < config["workers"]["yt_threads"] // 2
+        try:
+            while worth_trying:
+                await send_chat_action(message, 'typing')
+                try_count += 1
+                attempt_count += 1
+                worth_trying = False
+                # each attempt downloads to its own directory, as a timed out attempt may still be running (e.g. in ffmpeg) and writing to its files
+                attempt_target = os.path.join(target, f"{attempt_count}")
+                generation = yt_executor_generation
+                if try_count == 1 and use_thread:
+                    cancel_event = threading.Event()
+                    concurrent_future = yt_thread_executor.submit(create_ytml_and_download, kind, id, attempt_target, youtube_cookies_dir, cancel_event)
+                else:
+                    cancel_event = None
+                    concurrent_future = yt_executor.submit(create_ytml_and_download, kind, id, attempt_target, youtube_cookies_dir)
+                download_future = asyncio.wrap_future(concurrent_future)
+                try:
+                    await await_with_chat_action(
+                        asyncio.wait_for(download_future, timeout = TIMEOUT),
+                        message,
                         'typing'
                     )
-                )
-                await asyncio.to_thread(download_process.join, timeout = TIMEOUT)
-            except:
-                raise
-            else:
-                if download_process.is_alive():
+                except TimeoutError:
+                    if cancel_event:
+                        # a download stuck outside of yt-dlp's progress updates (e.g., in ffmpeg) keeps its thread until it finishes
+                        cancel_event.set()
+                        track_timed_out_yt_thread(concurrent_future)
+                    else:
+                        reset_yt_executor()
                     worth_trying = try_count < MAX_TRY_COUNT
                     if worth_trying:
                         print(
@@ -1260,93 +1477,122 @@ async def download_yt_and_reply(id: str, type: str, message: Message, compress =
                         )
                     else:
                         raise Timeout
-                else:
-                    exitcode = download_process.exitcode
-            finally:
-                download_process.terminate()
-                await asyncio.to_thread(download_process.join)
-                await reply_chat_action_task
-    except Timeout:
-        print(
-            f"{type.capitalize()} {id} donwload has been timed out; the maximum number of attempts ({MAX_TRY_COUNT}) reached.",
-            file = sys.stderr
-        )
-        await message.reply_html(
-            f"{sanitize_html_style(type.capitalize())} <code>{sanitize_html_style(id)}</code> download has failed ({MAX_TRY_COUNT} attempts). Please try again later."
-        )
-        await send_to_logging_chats(
-            f"{sanitize_html_style(type.capitalize())} <code>{sanitize_html_style(id)}</code> donwload has been timed out; the maximum number of attempts ({MAX_TRY_COUNT}) reached.",
-            message.get_bot()
-        )
-    except Exception as e:
-        print(
-            f"An error occured when downloading the {type} {id}:\n{traceback.format_exc()}",
-            file = sys.stderr
-        )
-        await message.reply_html(
-            f"An error occured when downloading the {sanitize_html_style(type)} <code>{sanitize_html_style(id)}</code>:\n<pre><code class=\"language-log\">{sanitize_html_style(str(e))}</code></pre>"
-        )
-        await send_to_logging_chats(
-            f"An error occured when downloading the {sanitize_html_style(type)} <code>{sanitize_html_style(id)}</code>:\n<pre><code class=\"language-log\">{sanitize_html_style(traceback.format_exc())}</code></pre>",
-            message.get_bot()
-        )
-    else:
-        if exitcode == 0:
-            try:
-                await message.reply_chat_action('upload_document')
-            except Exception:
-                print(
-                    f"Failed to set chat action:\n{traceback.format_exc()}",
-                    file = sys.stderr
-                )
-                    
-            if type != "short":
-                reply_yt_task = asyncio.create_task(
-                    reply_audios(target, message)
-                )
-            else:
-                reply_yt_task = asyncio.create_task(
-                    reply_media(target, message, compress)
-                )
-
-            reply_chat_action_task = asyncio.create_task(
-                repeat_until_task_done(
-                    5,  # see https://core.telegram.org/bots/api#sendchataction
-                    reply_yt_task,
-                    # message.reply_chat_action('upload_document')
-                    message.reply_chat_action,
-                    'upload_document'
-                )
-            )
-
-            await reply_yt_task
-            await reply_chat_action_task
-        else:
+                except BrokenProcessPool:
+                    if generation != yt_executor_generation:
+                        # the pool has been reset because of another download, so the attempt doesn't count
+                        try_count -= 1
+                        worth_trying = True
+                        print(f"The worker downloading the {type} {id} has been terminated by a reset of the pool; retrying...")
+                        continue
+                    # the worker has crashed
+                    worth_trying = try_count < MAX_TRY_COUNT
+                    if worth_trying:
+                        print(
+                            f"The worker downloading the {type} {id} has been terminated; retrying... [{try_count}/{MAX_TRY_COUNT}]"
+                        )
+                    else:
+                        raise
+        except Timeout:
             print(
-                f"{type.capitalize()} {id} download process terminated with exitcode {exitcode}",
+                f"{type.capitalize()} {id} donwload has been timed out; the maximum number of attempts ({MAX_TRY_COUNT}) reached.",
                 file = sys.stderr
             )
             await message.reply_html(
-                #exitcode is int
-                f"{sanitize_html_style(type.capitalize())} <code>{sanitize_html_style(id)}</code> download process terminated with exitcode <code>{exitcode}</code>"
+                f"{type.capitalize()} <code>{sanitize_html_style(id)}</code> download has failed ({MAX_TRY_COUNT} attempts). Please try again later."
             )
             await send_to_logging_chats(
-                #exitcode is int
-                f"{sanitize_html_style(type.capitalize())} <code>{sanitize_html_style(id)}</code> download process terminated with exitcode <code>{exitcode}</code>",
+                f"{type.capitalize()} <code>{sanitize_html_style(id)}</code> donwload has been timed out; the maximum number of attempts ({MAX_TRY_COUNT}) reached.",
                 message.get_bot()
             )
-    finally:
-        # remove target with all the files, if any were created
-        shutil.rmtree(target, ignore_errors = True)
+        except Exception as e:
+            await report_error(message, f"downloading the {type}", id, e)
+        else:
+            await send_chat_action(message, 'upload_document')
+                
+            if type != "short":
+                reply_yt_task = asyncio.create_task(
+                    reply_audios(attempt_target, message)
+                )
+            else:
+                reply_yt_task = asyncio.create_task(
+                    reply_media(attempt_target, message, compress)
+                )
 
+            await await_with_chat_action(reply_yt_task, message, 'upload_document')
 
-def find_first_of(text: str, chars: list[str]) -> int:
-    """Return the position of the first occurrence of any element of `chars` in `text`, or the length of `text` if there are no `chars`."""
-    res = len(text)
-    for char in chars:
-        if char in text:
-            res = min(res, text.find(char))
-    return res
+
+# the domains of all the supported links, each named after the links it may start
+# "music.youtube.com/" precedes the YouTube domains, which ensure that "youtube.com/" is not a part of "music.youtube.com/"; other occurrences of "youtube.com/" may only start YouTube Shorts links
+LINK_DOMAIN = re.compile(r"(?P<inst>instagram\.com/)|(?P<ytm>music\.youtube\.com/)|(?P<yt>(?:www\.|m\.|//| )youtube\.com/|youtu\.be/)|youtube\.com/")
+# the paths of links to Instagram posts and reels (https://www.instagram.com/p/<shortcode>), and to profile stories (https://www.instagram.com/stories/<username>) or certain stories (https://www.instagram.com/stories/<username>/<mediaid>)
+INST_PATH = re.compile(r"(?P<link_type>p|reel|reels|stories)/(?P<id>[^/? \n]+)(?:/(?P<mediaid>[^/? \n]+))?")
+# the domains that all the supported links contain ("youtube.com/" is also a part of "music.youtube.com/")
+SUPPORTED_DOMAINS = ("instagram.com/", "youtube.com/", "youtu.be/")
+# the paths of links to YouTube Shorts (https://www.youtube.com/shorts/<videoid>)
+YT_SHORTS_PATH = re.compile(r"shorts/(?P<id>[^&/? \n]+)")
+# the paths of shortened links to YouTube videos (https://youtu.be/<videoid>)
+YT_SHORTENED_PATH = re.compile(r"(?P<videoid>[^&/? \n]+)")
+# the paths of links to YouTube and YouTube Music songs and videos (watch?v=<videoid>, shorts/<videoid>) and albums (playlist?list=<playlistid>, browse/<playlistid>); the query parameters may come in any order
+YT_AUDIO_PATH = re.compile(r"(?:watch\?(?:[^ \n]*?&)?v=|shorts/)(?P<videoid>[^&/? \n]+)|(?:playlist\?(?:[^ \n]*?&)?list=|browse/)(?P<playlistid>[^&/? \n]+)")
+# the types of album ids, see https://github.com/tombulled/python-youtube-music/blob/0817d2688db3615a884453c6482008dac9977bf3/ytm/apis/AbstractYouTubeMusic/methods/album.py
+ALBUM_ID_TYPE = ytm.types.Union(
+    ytm.types.AlbumPlaylistId,
+    ytm.types.AlbumPlaylistBrowseId,
+    ytm.types.AlbumBrowseId,
+    ytm.types.AlbumId,
+    ytm.types.AlbumRadioId,
+    ytm.types.AlbumShuffleId,
+)
+
+
+async def run_with_semaphore(semaphore: asyncio.Semaphore, coroutine):
+    """Await `coroutine` while holding `semaphore` and return its result."""
+    async with semaphore:
+        return await coroutine
+
+
+async def handle_inst_link(link: re.Match, message: Message, compress: bool = True) -> bool:
+    """Initialize the download of an Instagram post, reel, story or profile stories from `link` (an ``INST_PATH`` match) and reply.
+
+    Return whether a download has been initialized.
+    """
+    download_initialized = False
+    L = get_instaloader(message.chat.id)
+    link_type = link["link_type"]
+    if link_type in ["p", "reel", "reels"]:
+        # it's a post / reel link (https://www.instagram.com/p/<shortcode> or https://www.instagram.com/reel/<shortcode>)
+        download_initialized = True
+        await download_post_and_reply(link["id"], message, compress)
+    else:  # link_type == "stories"
+        # it's a stories link, let's find out the type
+        username = link["id"]
+        mediaid = link["mediaid"]
+        try:
+            await send_chat_action(message, 'typing')
+
+            profile = await get_profile_cached(L, username)
+        except Exception as e:
+            await report_error(message, "retrieving the profile", username, e)
+        else:
+            if mediaid:
+                # it's a link to a certain story
+                # StoryItem.from_mediaid(L.context, mediaid) does not work, see https://github.com/instaloader/instaloader/issues/2531
+                # A workaround with L.get_stories() (see get_story_batched()):
+                try:
+                    story = await get_story_batched(L, profile.userid)
+                except Exception as e:
+                    await report_error(message, "retrieving the stories from profile", username, e)
+                else:
+                    for story_item in (story.get_items() if story else []):
+                        if str(story_item.mediaid) == mediaid:
+                            download_initialized = True
+                            await download_storyitem_and_reply(story_item, message, compress)
+            else:
+                # it's a link to profile's stories (https://www.instagram.com/stories/<username>)
+                download_initialized = True
+                await download_stories_and_reply(profile, message, compress)
+
+    return download_initialized
 
 
 async def handle_message(message: Message,
@@ -1387,156 +1633,64 @@ async def handle_message(message: Message,
     download_yt = download_yt and feature_state.features["yt"]
     
     download_initialized = False
+    if not (download_inst or download_yt_shorts or download_ytm or download_yt):
+        return download_initialized
     text_orig = message.text if message.text else message.caption
     if text_orig:
         # get markdown links
         entities = message.entities if message.entities else message.caption_entities
-        text_link_urls = [(entity.url + " ") for entity in [entity for entity in entities if entity.type == 'text_link']]
+        text_link_urls = [entity.url for entity in entities if entity.type == 'text_link']
+
+        # most messages contain no supported links, so they are not scanned by each of the parsers below
+        if not any(domain in text for text in [text_orig, *text_link_urls] for domain in SUPPORTED_DOMAINS):
+            return download_initialized
         if text_link_urls:
-            text_orig += " " + ' '.join(text_link_urls)
-
-        text = text_orig
-        L = L_captions if message.chat.id not in no_captions_chat_ids else L_no_captions
-        inst_domain = "instagram.com/"
-        while download_inst and inst_domain in text:
-            link_type_start = text.find(inst_domain) + len(inst_domain)
-            text = text[link_type_start:]
-            link_type_end = find_first_of(text, ['/'])
-            link_type = text[:link_type_end]
-            text = text[(link_type_end + 1):]
-            if link_type in ["p", "reel", "reels"]:
-                # it's a post / reel link (https://www.instagram.com/p/<shortcode> or https://www.instagram.com/reel/<shortcode>)
-                shortcode = text[:find_first_of(text, ['/', '?', ' ', '\n'])]
-                download_initialized = True
-                await download_post_and_reply(shortcode, message, compress)
-            elif link_type in ["stories"]:
-                # it's a stories link, let's find out the type
-                username = text[:find_first_of(text, ['/', '?', ' ', '\n'])]
-
-                first_slash = text.find("/") if "/" in text else len(text)
-                text = text[(first_slash + 1):]
-                mediaid = text[:find_first_of(text, ['/', '?', ' ', '\n'])]
-                try:
-                    try:
-                        await message.reply_chat_action('typing')
-                    except Exception:
-                        print(
-                            f"Failed to set chat action:\n{traceback.format_exc()}",
-                            file = sys.stderr
-                        )
-                    
-                    profile = Profile.from_username(L.context, username)
-                except Exception as e:
-                    print(
-                        f"An error occured when retrieving the profile {username}:\n{traceback.format_exc()}",
-                        file = sys.stderr
-                    )
-                    await message.reply_html(
-                        f"An error occured when retrieving the profile <code>{sanitize_html_style(username)}</code>:\n<pre><code class=\"language-log\">{sanitize_html_style(str(e))}</code></pre>"
-                    )
-                    await send_to_logging_chats(
-                        f"An error occured when retrieving the profile <code>{sanitize_html_style(username)}</code>:\n<pre><code class=\"language-log\">{sanitize_html_style(traceback.format_exc())}</code></pre>",
-                        message.get_bot()
-                    )
-                else:
-                    if mediaid:
-                        # it's a link to a certain story
-                        # StoryItem.from_mediaid(L.context, mediaid) does not work, see https://github.com/instaloader/instaloader/issues/2531
-                        # A workaround with L.get_stories():
-                        try:
-                            stories = L.get_stories([profile.userid])
-                        except Exception as e:
-                            print(
-                                f"An error occured when retrieving the stories from profile {username}:\n{traceback.format_exc()}",
-                                file = sys.stderr
-                            )
-                            await message.reply_html(
-                                f"An error occured when retrieving the stories from profile <code>{sanitize_html_style(username)}</code>:\n<pre><code class=\"language-log\">{sanitize_html_style(str(e))}</code></pre>"
-                            )
-                            await send_to_logging_chats(
-                                f"An error occured when retrieving the stories from profile <code>{sanitize_html_style(username)}</code>:\n<pre><code class=\"language-log\">{sanitize_html_style(traceback.format_exc())}</code></pre>",
-                                message.get_bot()
-                            )
-                        else:
-                            for story in stories:
-                                for story_item in story.get_items():
-                                    if str(story_item.mediaid) == mediaid:
-                                        download_initialized = True
-                                        await download_storyitem_and_reply(story_item, message, compress)
-                    else:
-                        # it's a link to profile's stories (https://www.instagram.com/stories/<username>)
-                        download_initialized = True
-                        await download_stories_and_reply(profile, message, compress)
-
-        text = text_orig
-        yt_shorts_domain = "youtube.com/shorts/"
-        while download_yt_shorts and yt_shorts_domain in text:
-            videoid_start = text.find(yt_shorts_domain) + len(yt_shorts_domain)
-            text = text[videoid_start:]
-            videoid = text[:find_first_of(text, ['&', '/', '?', ' ', '\n'])]
-            download_initialized = True
-            await download_yt_and_reply(videoid, "short", message, compress)
-
-        text = text_orig
-        audio_domains = []
-        if download_ytm: audio_domains.append("music.youtube.com/")
-        if download_yt:
-            # ensure that "youtube.com" is not a part of "music.youtube.com"
-            audio_domains.append(" youtube.com/")
-            audio_domains.append("www.youtube.com/")
-            audio_domains.append("//youtube.com/")
-            audio_domains.append("m.youtube.com/")
-            audio_domains.append("youtu.be/")
-        if audio_domains:
-            while any(domain in text for domain in audio_domains):
-                type_start = len(text)
-                for domain in audio_domains:
-                    if domain in text:
-                        domain_type_start = text.find(domain) + len(domain)
-                        if domain_type_start < type_start:
-                            postdomain_start = domain_type_start
-                            curr_domain = domain
-                text = text[postdomain_start:]
-                if curr_domain == "youtu.be/":
-                    # it's a shortened video link
-                    songid = text[:find_first_of(text, ['&', '/', '?', ' ', '\n'])]
+            text_orig += " " + ' '.join(url + " " for url in text_link_urls)
+
+        # all the links are found in a single pass over text_orig; the downloads are started in the order the links appear
+        # the downloads by what they download, so that repeated links (e.g. a YouTube Shorts link handled both as a short and as audio) are handled once, as each download has its own target directory
+        downloads = {}
+        for domain_match in LINK_DOMAIN.finditer(text_orig):
+            pos = domain_match.end()
+            if domain_match["inst"]:
+                if download_inst:
+                    link = INST_PATH.match(text_orig, pos)
+                    if link:
+                        key = ("stories", link["id"], link["mediaid"]) if link["link_type"] == "stories" else ("post", link["id"])
+                        if key not in downloads:
+                            # handle_inst_link() returns whether a download has been initialized
+                            downloads[key] = handle_inst_link(link, message, compress)
+                continue
+
+            if download_yt_shorts:
+                link = YT_SHORTS_PATH.match(text_orig, pos)
+                if link:
+                    download_initialized = True
+                    if ("short", link["id"]) not in downloads:
+                        downloads[("short", link["id"])] = download_yt_and_reply(link["id"], "short", message, compress)
+
+            if (download_ytm and domain_match["ytm"]) or (download_yt and domain_match["yt"]):
+                # a shortened video link or a link with a type ("watch?v=" | "shorts" | "playlist?list=" | "browse")
+                link = (YT_SHORTENED_PATH if domain_match[0] == "youtu.be/" else YT_AUDIO_PATH).match(text_orig, pos)
+                if not link:
+                    continue
+                songid = link["videoid"]
+                if songid:
                     download_initialized = True
-                    await download_yt_and_reply(songid, "audio", message)
+                    if ("audio", songid) not in downloads:
+                        downloads[("audio", songid)] = download_yt_and_reply(songid, "audio", message)
                 else:
-                    # it's a link with a type ("watch?v=" | "shorts" | "playlist?list=" | "browse")
-                    link_type_end = find_first_of(text, ['?', '/'])
-                    link_type = text[:link_type_end]
-                    text = text[(link_type_end + 1):]
-                    if link_type in ["watch"]:
-                        value_pref = "v=" 
-                        songid_start = text.find(value_pref) + len(value_pref)
-                        text = text[songid_start:]
-                        songid = text[:find_first_of(text, ['&', '/', '?', ' ', '\n'])]
+                    playlistid = link["playlistid"]
+                    # non-album playlists are not supported as YouTubeMusicDL.download_playlist is broken
+                    if ytm.utils.isinstance(playlistid, ALBUM_ID_TYPE):
                         download_initialized = True
-                        await download_yt_and_reply(songid, "audio", message)
-                    elif link_type in ["shorts"]:
-                        videoid = text[:find_first_of(text, ['&', '/', '?', ' ', '\n'])]
-                        download_initialized = True
-                        await download_yt_and_reply(videoid, "audio", message)
-                    elif link_type in ["playlist", "browse"]:
-                        if link_type == "playlist":
-                            value_pref = "list=" 
-                            playlistid_start = text.find(value_pref) + len(value_pref)
-                            text = text[playlistid_start:]
-                        playlistid = text[:find_first_of(text, ['&', '/', '?', ' ', '\n'])]
-                        # see https://github.com/tombulled/python-youtube-music/blob/0817d2688db3615a884453c6482008dac9977bf3/ytm/apis/AbstractYouTubeMusic/methods/album.py
-                        union_album_type = ytm.types.Union(
-                            ytm.types.AlbumPlaylistId,
-                            ytm.types.AlbumPlaylistBrowseId,
-                            ytm.types.AlbumBrowseId,
-                            ytm.types.AlbumId,
-                            ytm.types.AlbumRadioId,
-                            ytm.types.AlbumShuffleId,
-                        )
-                        # non-album playlists are not supported as YouTubeMusicDL.download_playlist is broken
-                        if ytm.utils.isinstance(playlistid, union_album_type):
-                            download_initialized = True
-                            await download_yt_and_reply(playlistid, "album", message)
+                        if ("album", playlistid) not in downloads:
+                            downloads[("album", playlistid)] = download_yt_and_reply(playlistid, "album", message)
+
+        # the downloads are mostly waiting for the network, so they run concurrently, bounded per message
+        semaphore = asyncio.Semaphore(config["workers"]["links"])
+        results = await asyncio.gather(*(run_with_semaphore(semaphore, download) for download in downloads.values()))
+        download_initialized = download_initialized or any(results)
     
     return download_initialized
 
@@ -1553,7 +1707,7 @@ async def check_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # update.effective_message is not None since it's a message handler
     message = update.effective_message
-    if await ensure_active_chat(message, context, public_reply = False) and await ensure_not_banned_author(message, context):
+    if await ensure_allowed(message, context, public_reply = False):
         download_initialized = await handle_message(message)
         if message.chat.type == 'private' and not download_initialized:
             await message.reply_html(
@@ -1563,17 +1717,19 @@ async def check_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def handle_mention(message: Message, context: ContextTypes.DEFAULT_TYPE, **handle_message_args):
     """
-    Call ``handle_message()`` for `message` and it's reply-to.
+    Call ``handle_message()`` for `message` and it's reply-to concurrently.
 
     Print the "no links" message if no downloads have been initialized.
     """
     config_context = config["messages"]
     
-    download_initialized_origin = await handle_message(message, **handle_message_args)
-    download_initialized_reply_to = False
+    messages_to_handle = [message]
     if message.reply_to_message:
-        download_initialized_reply_to = await handle_message(message.reply_to_message, **handle_message_args)
-    if not download_initialized_origin and not download_initialized_reply_to:
+        messages_to_handle.append(message.reply_to_message)
+    download_initialized = await asyncio.gather(
+        *(handle_message(message_to_handle, **handle_message_args) for message_to_handle in messages_to_handle)
+    )
+    if not any(download_initialized):
         await message.reply_html(
             await format_message(config_context["no_links"], context)
         )
@@ -1588,7 +1744,7 @@ async def mentioned(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     # update.effective_message is not None since it's a message handler
     message = update.effective_message
-    if await ensure_active_chat(message, context) and await ensure_not_banned_author(message, context):
+    if await ensure_allowed(message, context):
         await handle_mention(message, context)
 
 
@@ -1606,7 +1762,7 @@ async def uncompressed(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     # update.effective_message is not None since it's a command handler
     message = update.effective_message
-    if await ensure_active_chat(message, context) and await ensure_not_banned_author(message, context):
+    if await ensure_allowed(message, context):
         await handle_mention(message, context, download_inst = True, download_ytm = False, download_yt = False, download_yt_shorts = True, compress = False)
 
 
@@ -1623,7 +1779,7 @@ async def audio(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     # update.effective_message is not None since it's a command handler
     message = update.effective_message
-    if await ensure_active_chat(message, context) and await ensure_not_banned_author(message, context):
+    if await ensure_allowed(message, context):
         await handle_mention(message, context, download_inst = False, download_ytm = False, download_yt = True, download_yt_shorts = True)
 
 
@@ -1667,26 +1823,31 @@ async def enable_chats(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await message.reply_html(
                     await format_message(config_context["no_args"], context)
                 )
+        # the successful changes are saved with a single backup
+        changed_args = []
+        # the replies are sent concurrently
+        replies = []
         for arg in context.args:
-            try:
-                chat_id = int(arg)
-            except Exception:
-                await message.reply_html(
-                    await format_message(config_context["arg_not_int"], context, arg = arg)
+            chat_id = parse_id(arg)
+            if chat_id is None:
+                replies.append(
+                    reply_formatted(message, config_context["arg_not_int"], context, arg = arg)
                 )
             else:
                 if chat_id in active_chat_ids:
-                    await message.reply_html(
-                        await format_message(config_context["no_need"], context, arg = arg)
+                    replies.append(
+                        reply_formatted(message, config_context["no_need"], context, arg = arg)
                     )
                 else:
-                    future = await active_chat_ids.add(chat_id)
-                    await future
-                    future = await active_chat_ids.backup()
-                    await future
-                    await message.reply_html(
-                        await format_message(config_context["success"], context, arg = arg)
-                    )
+                    active_chat_ids.add(chat_id)
+                    changed_args.append(arg)
+        if changed_args:
+            replies.append(await active_chat_ids.backup())
+        # the changes are confirmed once they are saved
+        await asyncio.gather(*replies)
+        await asyncio.gather(
+            *(reply_formatted(message, config_context["success"], context, arg = arg) for arg in changed_args)
+        )
 
 
 async def disable_chats(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1708,26 +1869,31 @@ async def disable_chats(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await message.reply_html(
                     await format_message(config_context["no_args"], context)
                 )
+        # the successful changes are saved with a single backup
+        changed_args = []
+        # the replies are sent concurrently
+        replies = []
         for arg in context.args:
-            try:
-                chat_id = int(arg)
-            except Exception:
-                await message.reply_html(
-                    await format_message(config_context["arg_not_int"], context, arg = arg)
+            chat_id = parse_id(arg)
+            if chat_id is None:
+                replies.append(
+                    reply_formatted(message, config_context["arg_not_int"], context, arg = arg)
                 )
             else:
                 if chat_id not in active_chat_ids:
-                    await message.reply_html(
-                        await format_message(config_context["no_need"], context, arg = arg)
+                    replies.append(
+                        reply_formatted(message, config_context["no_need"], context, arg = arg)
                     )
                 else:
-                    future = await active_chat_ids.discard(chat_id)
-                    await future
-                    future = await active_chat_ids.backup()
-                    await future
-                    await message.reply_html(
-                        await format_message(config_context["success"], context, arg = arg)
-                    )
+                    active_chat_ids.discard(chat_id)
+                    changed_args.append(arg)
+        if changed_args:
+            replies.append(await active_chat_ids.backup())
+        # the changes are confirmed once they are saved
+        await asyncio.gather(*replies)
+        await asyncio.gather(
+            *(reply_formatted(message, config_context["success"], context, arg = arg) for arg in changed_args)
+        )
 
 
 async def ban_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1749,32 +1915,37 @@ async def ban_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await message.reply_html(
                     await format_message(config_context["no_args"], context)
                 )
+        # the successful changes are saved with a single backup
+        changed_args = []
+        # the replies are sent concurrently
+        replies = []
         for arg in context.args:
-            try:
-                user_id = int(arg)
-            except Exception:
-                await message.reply_html(
-                    await format_message(config_context["arg_not_int"], context, arg = arg)
+            user_id = parse_id(arg)
+            if user_id is None:
+                replies.append(
+                    reply_formatted(message, config_context["arg_not_int"], context, arg = arg)
                 )
             else:
                 if not is_admin(user_id):
                     # the user we're going to ban is not an admin
                     if user_id in banned_user_ids:
-                        await message.reply_html(
-                            await format_message(config_context["no_need"], context, arg = arg)
+                        replies.append(
+                            reply_formatted(message, config_context["no_need"], context, arg = arg)
                         )
                     else:
-                        future = await banned_user_ids.add(user_id)
-                        await future
-                        future = await banned_user_ids.backup()
-                        await future
-                        await message.reply_html(
-                            await format_message(config_context["success"], context, arg = arg)
-                        )
+                        banned_user_ids.add(user_id)
+                        changed_args.append(arg)
                 else:
-                    await message.reply_html(
-                        await format_message(config_context["arg_admin"], context, arg = arg)
+                    replies.append(
+                        reply_formatted(message, config_context["arg_admin"], context, arg = arg)
                     )
+        if changed_args:
+            replies.append(await banned_user_ids.backup())
+        # the changes are confirmed once they are saved
+        await asyncio.gather(*replies)
+        await asyncio.gather(
+            *(reply_formatted(message, config_context["success"], context, arg = arg) for arg in changed_args)
+        )
 
 
 async def unban_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1796,27 +1967,32 @@ async def unban_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await message.reply_html(
                     await format_message(config_context["no_args"], context)
                 )
+        # the successful changes are saved with a single backup
+        changed_args = []
+        # the replies are sent concurrently
+        replies = []
         for arg in context.args:
-            try:
-                user_id = int(arg)
-            except Exception:
-                await message.reply_html(
-                    await format_message(config_context["arg_not_int"], context, arg = arg)
+            user_id = parse_id(arg)
+            if user_id is None:
+                replies.append(
+                    reply_formatted(message, config_context["arg_not_int"], context, arg = arg)
                 )
             else:
                 # we don't need to check is_admin(user_id) here, as if an admin is somehow banned (which should be impossible), there must be an option to unban them (available for them as well)
                 if user_id not in banned_user_ids:
-                    await message.reply_html(
-                        await format_message(config_context["no_need"], context, arg = arg)
+                    replies.append(
+                        reply_formatted(message, config_context["no_need"], context, arg = arg)
                     )
                 else:
-                    future = await banned_user_ids.discard(user_id)
-                    await future
-                    future = await banned_user_ids.backup()
-                    await future
-                    await message.reply_html(
-                        await format_message(config_context["success"], context, arg = arg)
-                    )
+                    banned_user_ids.discard(user_id)
+                    changed_args.append(arg)
+        if changed_args:
+            replies.append(await banned_user_ids.backup())
+        # the changes are confirmed once they are saved
+        await asyncio.gather(*replies)
+        await asyncio.gather(
+            *(reply_formatted(message, config_context["success"], context, arg = arg) for arg in changed_args)
+        )
 
 
 async def enable_features(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1838,26 +2014,38 @@ async def enable_features(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await message.reply_html(
                 await format_message(config_context["no_args"], context)
             )
+        # the successful changes are saved with a single backup
+        changed_args = []
+        # the replies are sent concurrently
+        replies = []
         for arg in context.args:
-            if arg not in feature_state.features:
-                await message.reply_html(
-                    await format_message(config_context["arg_not_valid"], context, arg = arg)
+            # a single lookup tells both whether the feature is valid and whether it is enabled
+            enabled = feature_state.features.get(arg)
+            if enabled is None:
+                replies.append(
+                    reply_formatted(message, config_context["arg_not_valid"], context, arg = arg)
+                )
+            elif enabled:
+                replies.append(
+                    reply_formatted(message, config_context["no_need"], context, arg = arg, feature = FEATURE_NAMES[arg])
                 )
             else:
-                if feature_state.features[arg]:
-                    await message.reply_html(
-                        await format_message(config_context["no_need"], context, arg = arg, feature = FEATURE_NAMES[arg])
-                    )
-                else:
-                    future = await feature_state.set(arg, True)
-                    await future
-                    future = await feature_state.backup()
-                    await future
-                    await message.reply_html(
-                        await format_message(config_context["success"], context, arg = arg, feature = FEATURE_NAMES[arg])
-                    )
-                    await send_to_active_chats(config["messages"]["notifications"]["feature_enabled"], context.bot, [update.effective_chat.id], feature = FEATURE_NAMES[arg])
-                    await send_to_logging_chats(config["messages"]["notifications"]["feature_enabled"], context.bot, feature = FEATURE_NAMES[arg])
+                feature_state.set(arg, True)
+                changed_args.append(arg)
+        if changed_args:
+            replies.append(await feature_state.backup())
+        # the changes are confirmed once they are saved
+        await asyncio.gather(*replies)
+        notification = config["messages"]["notifications"]["feature_enabled"]
+        replies = []
+        for arg in changed_args:
+            feature_name = FEATURE_NAMES[arg]
+            replies += [
+                reply_formatted(message, config_context["success"], context, arg = arg, feature = feature_name),
+                send_to_active_chats(notification, context.bot, [update.effective_chat.id], feature = feature_name),
+                send_to_logging_chats(notification, context.bot, feature = feature_name)
+            ]
+        await asyncio.gather(*replies)
 
 
 async def disable_features(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1879,26 +2067,38 @@ async def disable_features(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await message.reply_html(
                 await format_message(config_context["no_args"], context)
             )
+        # the successful changes are saved with a single backup
+        changed_args = []
+        # the replies are sent concurrently
+        replies = []
         for arg in context.args:
-            if arg not in feature_state.features:
-                await message.reply_html(
-                    await format_message(config_context["arg_not_valid"], context, arg = arg)
+            # a single lookup tells both whether the feature is valid and whether it is enabled
+            enabled = feature_state.features.get(arg)
+            if enabled is None:
+                replies.append(
+                    reply_formatted(message, config_context["arg_not_valid"], context, arg = arg)
+                )
+            elif not enabled:
+                replies.append(
+                    reply_formatted(message, config_context["no_need"], context, arg = arg, feature = FEATURE_NAMES[arg])
                 )
             else:
-                if not feature_state.features[arg]:
-                    await message.reply_html(
-                        await format_message(config_context["no_need"], context, arg = arg, feature = FEATURE_NAMES[arg])
-                    )
-                else:
-                    future = await feature_state.set(arg, False)
-                    await future
-                    future = await feature_state.backup()
-                    await future
-                    await message.reply_html(
-                        await format_message(config_context["success"], context, arg = arg, feature = FEATURE_NAMES[arg])
-                    )
-                    await send_to_active_chats(config["messages"]["notifications"]["feature_disabled"], context.bot, [update.effective_chat.id], feature = FEATURE_NAMES[arg])
-                    await send_to_logging_chats(config["messages"]["notifications"]["feature_disabled"], context.bot, feature = FEATURE_NAMES[arg])
+                feature_state.set(arg, False)
+                changed_args.append(arg)
+        if changed_args:
+            replies.append(await feature_state.backup())
+        # the changes are confirmed once they are saved
+        await asyncio.gather(*replies)
+        notification = config["messages"]["notifications"]["feature_disabled"]
+        replies = []
+        for arg in changed_args:
+            feature_name = FEATURE_NAMES[arg]
+            replies += [
+                reply_formatted(message, config_context["success"], context, arg = arg, feature = feature_name),
+                send_to_active_chats(notification, context.bot, [update.effective_chat.id], feature = feature_name),
+                send_to_logging_chats(notification, context.bot, feature = feature_name)
+            ]
+        await asyncio.gather(*replies)
 
 
 async def send_notification(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1958,18 +2158,53 @@ async def send_forced_notification(update: Update, context: ContextTypes.DEFAULT
             await send_to_logging_chats("Forced Notification:\n" + notification, context.bot)
 
 
+async def post_shutdown(application: Application) -> None:
+    """Persist the state that is still pending, stop the download workers and remove the local copies of the YouTube cookie file when ``Application.run_polling()`` shuts down."""
+    yt_thread_executor.shutdown(wait = False, cancel_futures = True)
+    yt_executor.shutdown(wait = False, cancel_futures = True)
+    await close_state()
+    if youtube_cookies_dir:
+        await asyncio.to_thread(shutil.rmtree, youtube_cookies_dir, ignore_errors = True)
+
+
+async def load_instaloaders() -> tuple[instaloader.Instaloader, instaloader.Instaloader]:
+    """Return ``get_instaloaders()``, called in a worker thread, once the session is tested (see ``test_instaloader_logins()``)."""
+    L_captions, L_no_captions = await asyncio.to_thread(get_instaloaders)
+    # the instances share the session, so it is tested once
+    await test_instaloader_logins(L_captions)
+    return L_captions, L_no_captions
+
+
 async def setup() -> Application:
     global application  #required by error_catcher()
+    global event_loop  #required by error_catcher()
+    global L_captions, L_no_captions
+    global youtube_cookies_dir
 
     logging.basicConfig(
         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
         level=logging.WARNING
     )
 
+    # the default executor runs the short blocking calls (opening, listing and removing files, extracting covers, etc.); its default size depends on the number of CPUs, which is small on a typical server
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers = config["workers"]["io"], thread_name_prefix = "io")
+    )
+    if STATE_BUCKET:
+        youtube_cookies_dir = await asyncio.to_thread(tempfile.mkdtemp, prefix = "tg-load-")
+
     defaults = Defaults(do_quote = True)
-    application = ApplicationBuilder().token(env("TOKEN")).defaults(defaults).read_timeout(30).build()
-    # we need to initialize application to fetch the bot's properties
-    await application.initialize()
+    # a slow download in one chat doesn't hold up the updates from the other chats
+    update_processor = ChatUpdateProcessor(config["workers"]["updates"])
+    # the requests are paced to Telegram's rate limits, and the ones answered with RetryAfter are retried
+    rate_limiter = AIORateLimiter(max_retries = 3)
+    application = ApplicationBuilder().token(env("TOKEN")).defaults(defaults).read_timeout(30).concurrent_updates(update_processor).rate_limiter(rate_limiter).post_shutdown(post_shutdown).build()
+    # we need to initialize application to fetch the bot's properties; meanwhile, the Instagram session is loaded and tested
+    (L_captions, L_no_captions), _ = await asyncio.gather(
+        load_instaloaders(),
+        application.initialize()
+    )
+    event_loop = asyncio.get_running_loop()
     for L in [L_captions, L_no_captions]:
         L.context.error_catcher = MethodType(error_catcher, L.context)
     
@@ -1983,8 +2218,9 @@ async def setup() -> Application:
         CommandHandler('disable_notifications', disable_notifications),
         CommandHandler('enable_notifications', enable_notifications),
         CommandHandler('state', state),
-        CommandHandler('uncompressed', uncompressed),
-        CommandHandler('audio', audio),
+        # the downloads run as separate tasks (block = False), so that they don't hold back the next updates from the chat
+        CommandHandler('uncompressed', uncompressed, block = False),
+        CommandHandler('audio', audio, block = False),
         CommandHandler('admin_commands', admin_commands),
         CommandHandler('enable_chats', enable_chats),
         CommandHandler('disable_chats', disable_chats),
@@ -1996,12 +2232,12 @@ async def setup() -> Application:
         CommandHandler('send_forced_notification', send_forced_notification),
         MessageHandler(filters.UpdateType.MESSAGE &
                        (filters.Mention(application.bot.name) | filters.ChatType.PRIVATE),
-                       mentioned
+                       mentioned,
+                       block = False
         ),
-        MessageHandler(filters.UpdateType.MESSAGE &
-                       ((filters.TEXT & (filters.Entity('url') | filters.Entity('text_link'))) |
-                       (filters.CAPTION & (filters.CaptionEntity('url') | filters.CaptionEntity('text_link')))),
-                       check_message
+        MessageHandler(filters.UpdateType.MESSAGE & LinkFilter(),
+                       check_message,
+                       block = False
         ),
     ])  # group = 0 (default)
 
@@ -1,8 +1,150 @@
+import asyncio
+import json
+import os
+import sys
+import tempfile
+
+from pathlib import Path
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps_json(content, pretty: bool = False) -> str:
+    """Serialize `content` to compact JSON, or, if `pretty` is ``True``, to indented JSON with sorted keys. orjson is used if it is installed."""
+    if orjson:
+        option = orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS if pretty else None
+        return orjson.dumps(content, option = option).decode("utf-8")
+    if pretty:
+        return json.dumps(content, indent = 4, sort_keys = True)
+    return json.dumps(content, separators = (",", ":"))
+
+
+def loads_json(data: bytes | str):
+    """Deserialize `data` from JSON. orjson is used if it is installed."""
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def install_uvloop() -> bool:
+    """Make asyncio create uvloop event loops, if uvloop is installed and supported on this platform. Returns whether uvloop was installed."""
+    if sys.platform == "win32":
+        return False
+    try:
+        import uvloop
+    except ImportError:
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
+
+
+def listdir_by_ctime(directory) -> list[str]:
+    """Return the names of the entries in `directory`, sorted by their ctime."""
+    with os.scandir(directory) as entries:
+        return [entry.name for entry in sorted(entries, key = lambda entry: entry.stat().st_ctime)]
+
+
 def deep_merge(base: dict, override: dict) -> dict:
-    """Returns `base`, overriding non-dict keys present in `override` with the values from `override`. Nested dicts are merged recursively."""
-    for key, value in override.items():
-        if key in base and isinstance(base[key], dict) and isinstance(value, dict):
-            base[key] = deep_merge(base[key], value)
-        else:
-            base[key] = value
+    """Returns `base`, overriding non-dict keys present in `override` with the values from `override`. Nested dicts are merged in place."""
+    # (base, override) pairs of the dicts left to merge
+    stack = [(base, override)]
+    while stack:
+        base_dict, override_dict = stack.pop()
+        for key, value in override_dict.items():
+            base_value = base_dict.get(key)
+            if isinstance(base_value, dict) and isinstance(value, dict):
+                stack.append((base_value, value))
+            else:
+                base_dict[key] = value
     return base
+
+
+FSYNC_INTERVAL = 0.5
+
+# Paths written since the last batched fsync; they are opened only at flush time, so that the file currently at each path (rather than a since replaced one) is synced
+_dirty_paths: set[Path] = set()
+_fsync_task = None
+
+
+def _open_for_fsync(path: Path) -> int:
+    """Open `path` (a file or, on POSIX, a directory) so that it can be passed to ``os.fsync()``."""
+    if path.is_dir():
+        return os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    return os.open(path, os.O_RDONLY if os.name == "posix" else os.O_RDWR)
+
+
+def _fsync_all(paths: list[Path]) -> None:
+    """Open each of `paths` and call ``os.fsync()`` on it."""
+    for path in paths:
+        try:
+            fd = _open_for_fsync(path)
+        except OSError as e:
+            print(e, file = sys.stderr)
+            continue
+        try:
+            os.fsync(fd)
+        except OSError as e:
+            print(e, file = sys.stderr)
+        finally:
+            os.close(fd)
+
+
+async def sync_pending() -> None:
+    """Flush all the paths queued by `schedule_fsync()` to disk."""
+    paths = list(_dirty_paths)
+    _dirty_paths.clear()
+    if paths:
+        await asyncio.to_thread(_fsync_all, paths)
+
+
+async def _fsync_periodically() -> None:
+    """Call `sync_pending()` every `FSYNC_INTERVAL` seconds while there is something to sync."""
+    global _fsync_task
+    try:
+        while _dirty_paths:
+            await asyncio.sleep(FSYNC_INTERVAL)
+            await sync_pending()
+    finally:
+        _fsync_task = None
+
+
+def schedule_fsync(path: Path) -> None:
+    """Queue `path` and, on POSIX, its parent directory for the next batched fsync. Repeated writes to the same path within one batch are synced once."""
+    global _fsync_task
+    _dirty_paths.update([path, path.parent] if os.name == "posix" else [path])
+    if _fsync_task is None:
+        _fsync_task = asyncio.create_task(_fsync_periodically())
+
+
+def _write_and_replace(path: Path, content: str) -> None:
+    """Write `content` to a temporary file (see ``tempfile.mkstemp()``) next to `path`, then atomically replace `path` with it."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    fd, tmppath = tempfile.mkstemp(
+        prefix = path.name + ".",
+        suffix = ".tmp",
+        dir = path.parent
+    )
+    try:
+        with os.fdopen(fd, "w", encoding = "utf-8") as file:
+            file.write(content)
+        os.replace(tmppath, path)
+    except BaseException:
+        Path(tmppath).unlink(missing_ok=True)
+        raise
+
+
+async def atomic_write(filepath: str, content: str, fsync: bool = False) -> None:
+    """
+    Safely write `content` to `filepath`: the text is written to a temporary file (see ``tempfile.mkstemp()``), which then atomically replaces `filepath`. The blocking calls run in a thread, so that the event loop isn't held up.
+
+    If `fsync` is ``True``, the file and its directory are queued for the next batched fsync (see `schedule_fsync()`), so that many writes within `FSYNC_INTERVAL` cost one fsync per path.
+    """
+    path = Path(filepath)
+    await asyncio.to_thread(_write_and_replace, path, content)
+
+    if fsync:
+        schedule_fsync(path)
@@ -0,0 +1,37 @@
+import datetime
+
+import pytest
+
+pytest.importorskip("telegram")
+
+from telegram import Chat, Message, MessageEntity
+
+from tg_load.linkfilter import LinkFilter
+
+
+def make_message(**kwargs) -> Message:
+    return Message(1, datetime.datetime.now(datetime.UTC), Chat(1, Chat.PRIVATE), **kwargs)
+
+
+def test_text_with_url():
+    message = make_message(text = "https://youtu.be/x", entities = [MessageEntity(MessageEntity.URL, 0, 18)])
+    assert LinkFilter().filter(message)
+
+
+def test_text_with_text_link():
+    message = make_message(text = "link", entities = [MessageEntity(MessageEntity.TEXT_LINK, 0, 4, url = "https://youtu.be/x")])
+    assert LinkFilter().filter(message)
+
+
+def test_caption_with_url():
+    message = make_message(caption = "https://youtu.be/x", caption_entities = [MessageEntity(MessageEntity.URL, 0, 18)])
+    assert LinkFilter().filter(message)
+
+
+def test_text_without_links():
+    message = make_message(text = "#tag", entities = [MessageEntity(MessageEntity.HASHTAG, 0, 4)])
+    assert not LinkFilter().filter(message)
+
+
+def test_message_without_text():
+    assert not LinkFilter().filter(make_message())
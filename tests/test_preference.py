@@ -0,0 +1,94 @@
+import asyncio
+
+from tg_load import preference
+from tg_load.preference import Preference
+
+
+def test_load_ndjson(tmp_path):
+    filepath = tmp_path / "preference.txt"
+    filepath.write_text('-100123\n42\n"user"\n', encoding = "utf-8")
+    assert Preference(str(filepath)).set == {-100123, 42, "user"}
+
+
+def test_load_legacy_set_literal(tmp_path):
+    filepath = tmp_path / "preference.txt"
+    filepath.write_text("{-100123, 42}", encoding = "utf-8")
+    assert Preference(str(filepath)).set == {-100123, 42}
+
+
+def test_load_missing_file(tmp_path):
+    assert Preference(str(tmp_path / "missing.txt")).set == set()
+
+
+def test_backup_round_trip(tmp_path):
+    filepath = str(tmp_path / "preference.txt")
+
+    async def main():
+        pref = Preference(filepath, flush_delay = 0)
+        pref.add(2)
+        pref.add(1)
+        await (await pref.backup())
+        await pref.aclose()
+
+    asyncio.run(main())
+    assert Preference(filepath).set == {1, 2}
+
+
+def test_backup_coalesces_calls(tmp_path, monkeypatch):
+    writes = []
+
+    async def atomic_write(filepath, content, fsync = False):
+        writes.append(content)
+
+    monkeypatch.setattr(preference, "atomic_write", atomic_write)
+
+    async def main():
+        pref = Preference(str(tmp_path / "preference.txt"), flush_delay = 0.05, stable_order = True)
+        futures = []
+        for item in range(3):
+            pref.add(item)
+            futures.append(await pref.backup())
+        assert futures[0] is futures[1] is futures[2]
+        await futures[0]
+        await pref.aclose()
+
+    asyncio.run(main())
+    assert writes == ["0\n1\n2"]
+
+
+def test_backup_flushes_at_max_pending(tmp_path, monkeypatch):
+    writes = []
+
+    async def atomic_write(filepath, content, fsync = False):
+        writes.append(content)
+
+    monkeypatch.setattr(preference, "atomic_write", atomic_write)
+
+    async def main():
+        pref = Preference(str(tmp_path / "preference.txt"), flush_delay = 60, max_pending = 2)
+        pref.add(1)
+        await pref.backup()
+        pref.add(2)
+        future = await pref.backup()
+        await asyncio.wait_for(future, timeout = 1)
+
+    asyncio.run(main())
+    assert len(writes) == 1
+
+
+def test_backup_skips_unchanged_set(tmp_path, monkeypatch):
+    writes = []
+
+    async def atomic_write(filepath, content, fsync = False):
+        writes.append(content)
+
+    monkeypatch.setattr(preference, "atomic_write", atomic_write)
+
+    async def main():
+        pref = Preference(str(tmp_path / "preference.txt"))
+        future = await pref.backup()
+        assert future.done()
+        await pref.aclose()
+
+    asyncio.run(main())
+    assert writes == []
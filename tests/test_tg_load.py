@@ -0,0 +1,56 @@
+import asyncio
+import datetime
+import pathlib
+
+import pytest
+
+# tg_load.tg_load needs the full set of dependencies (including python-youtube-music with YouTubeMusicDL support) and src/tg_load/settings/config.toml
+pytest.importorskip("telegram")
+pytest.importorskip("instaloader")
+pytest.importorskip("yt_dlp")
+pytest.importorskip("mutagen")
+pytest.importorskip("ytm.apis.YouTubeMusicDL.YouTubeMusicDL")
+if not (pathlib.Path(__file__).resolve().parents[1] / "src" / "tg_load" / "settings" / "config.toml").is_file():
+    pytest.skip("src/tg_load/settings/config.toml is required", allow_module_level = True)
+
+from telegram import Chat, Message
+
+from tg_load import tg_load
+
+
+@pytest.mark.parametrize("arg, expected", [
+    ("123", 123),
+    ("-1001234567890", -1001234567890),
+    ("0", 0),
+    ("", None),
+    ("-", None),
+    ("12a", None),
+    ("+5", None),
+    ("1.5", None),
+    (" 1", None),
+    ("1" * 21, None),
+])
+def test_parse_id(arg, expected):
+    assert tg_load.parse_id(arg) == expected
+
+
+def test_handle_message_handles_repeated_links_once(monkeypatch):
+    calls = []
+
+    async def download_yt_and_reply(id, type, message, compress = True):
+        calls.append((id, type))
+
+    monkeypatch.setattr(tg_load, "download_yt_and_reply", download_yt_and_reply)
+    for feature, enabled in {"inst": False, "yt_shorts": True, "ytm": True, "yt": False}.items():
+        monkeypatch.setitem(tg_load.feature_state.features, feature, enabled)
+
+    text = " ".join([
+        "https://youtube.com/shorts/abc",
+        "https://youtube.com/shorts/abc",
+        "https://music.youtube.com/watch?v=def",
+        "https://music.youtube.com/watch?si=x&v=def",
+    ])
+    message = Message(1, datetime.datetime.now(datetime.UTC), Chat(1, Chat.PRIVATE), text = text)
+
+    assert asyncio.run(tg_load.handle_message(message))
+    assert calls == [("abc", "short"), ("def", "audio")]
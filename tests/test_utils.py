@@ -0,0 +1,20 @@
+from tg_load.utils import deep_merge
+
+
+def test_deep_merge_overrides_values():
+    base = {"a": 1, "b": 2}
+    assert deep_merge(base, {"b": 3, "c": 4}) == {"a": 1, "b": 3, "c": 4}
+
+
+def test_deep_merge_merges_nested_dicts_in_place():
+    nested = {"x": 1, "y": {"z": 2}}
+    base = {"nested": nested, "other": 0}
+    merged = deep_merge(base, {"nested": {"y": {"w": 3}}})
+    assert merged is base
+    assert base["nested"] is nested
+    assert merged == {"nested": {"x": 1, "y": {"z": 2, "w": 3}}, "other": 0}
+
+
+def test_deep_merge_replaces_a_non_dict_with_a_dict_and_vice_versa():
+    base = {"a": 1, "b": {"c": 2}}
+    assert deep_merge(base, {"a": {"d": 3}, "b": 4}) == {"a": {"d": 3}, "b": 4}